@@ -1,8 +1,5 @@
 # bot.py
 import discord
-from discord.ext import commands
-import os
-import json
 import logging
 import re
 import asyncio
@@ -11,9 +8,10 @@ from report import *
 from flow import *
 from reactions import Reaction, ReactionDelegator
 from time import time
-from content_reviewer import ContentReviewer, CSAM_SCORE_THRESHOLD
-from azure.cognitiveservices.vision.computervision import ComputerVisionClient
-from msrest.authentication import CognitiveServicesCredentials
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict, deque
+from cache import LRUCache
+from content_reviewer import ContentReviewer, CSAM_SCORE_THRESHOLD, worth_reviewing, load_tokens
 from consts import *
 
 
@@ -27,7 +25,97 @@ FILTER_DMS = False
 # This is True by default
 SMART_SPOILERS = True
 # DM the bot .debug smart_spoilers enable/disable/toggle to turn them on and off
-
+SMART_SPOILERS_PREFIX = ".debug smart_spoilers "
+# Maps each argument to the value smart spoilers get set to (None toggles them)
+SMART_SPOILERS_COMMANDS = {
+    "enable": True,
+    "disable": False,
+    "toggle": None
+}
+
+# The maximum number of image reviews that can be running at the same time
+# (text reviews are batched up by the reviewer instead; see PerspectiveBatcher)
+# Any other messages wait for a free slot instead of flooding the APIs during a burst
+REVIEW_CONCURRENCY = 16
+
+# The maximum number of CSAM image reports from the same message that get created and sent at the same time
+REPORT_CONCURRENCY = 4
+
+# The maximum number of report messages being sent to mod channels at the same time (across every report)
+# so that a burst of reports is spread out instead of running into Discord's rate limits all at once
+MOD_SEND_CONCURRENCY = 8
+
+# The number of message IDs (three for each message the bot re-sends) whose ResentMessage is remembered
+RESENT_MESSAGE_CAPACITY = 30000
+
+# The most edited messages that can be waiting on their author to re-edit or re-send them at once
+# Their flows time out after ten minutes, so this is only ever reached if something keeps them from cleaning up after themselves
+PENDING_EDIT_CAPACITY = 5000
+
+# The number of users whose DM channel is remembered (discord.py only keeps the 128 most recent ones itself)
+DM_CHANNEL_CAPACITY = 10000
+
+# The most seconds shutting down waits for messages that are still being handled before cancelling them
+MESSAGE_DRAIN_TIMEOUT = 30
+
+# The most seconds shutting down waits for queued NCMEC reports to be sent before giving up on them (they're logged instead)
+NCMEC_DRAIN_TIMEOUT = 30
+
+# The most channel messages that can be waiting to be handled at once; any more are dropped (and logged) instead of piling up during a flood
+MAX_PENDING_MESSAGES = 1000
+# The most messages that can be handled at the same time
+# This is more than the 8 a small worker pool would use so that text reviews can still fill up a Perspective batch
+MESSAGE_WORKERS = 32
+
+# Rules for flagging a message's textual content, checked in order so that the first matching rule wins
+# Each rule is (attributes, threshold, explicit, abuse type, explanation) and matches if any of its attributes scores over the threshold
+TEXT_RULES = (
+    # Explicit messages
+    (("SEXUALLY_EXPLICIT",), 0.9, True, AbuseType.SEXUAL, "as sexually explicit"),
+    (("SEVERE_TOXICITY",), 0.9, True, AbuseType.HARASS, "as toxic"),
+    (("THREAT",), 0.9, True, AbuseType.VIOLENCE, "as threatening"),
+    (("IDENTITY_ATTACK",), 0.9, True, AbuseType.HATEFUL, "as hateful"),
+    # Non-explicit messages
+    (("SEXUALLY_EXPLICIT",), 0.75, False, AbuseType.SEXUAL, "as sexually explicit"),
+    (("THREAT",), 0.75, False, AbuseType.VIOLENCE, "for inciting violence"),
+    (("IDENTITY_ATTACK",), 0.75, False, AbuseType.HATEFUL, "as hateful"),
+    (("TOXICITY", "INSULT"), 0.9, False, AbuseType.HARASS, "as toxic"),
+    (("FLIRTATION",), 0.8, False, AbuseType.HARASS, "as flirtation")
+)
+# Newly sent messages are also checked for spam (edited messages aren't)
+MESSAGE_TEXT_RULES = TEXT_RULES + (
+    (("SPAM",), 0.9, False, AbuseType.SPAM, "as spam"),
+)
+# Rules for flagging a message's image attachments (checked against the maximum score of each category across all of them)
+IMAGE_RULES = (
+    (("ADULT",), 0.85, True, AbuseType.SEXUAL, "for having a sexually explicit image"),
+    (("GORE",), 0.75, True, AbuseType.VIOLENCE, "as promoting violence for having a bloody/gory image"),
+    (("RACY",), 0.8, True, AbuseType.SEXUAL, "as having a sexually suggestive image")
+)
+# Messages that don't match any rule but score over any of these thresholds are uncertain and get an SOS
+SOS_THRESHOLDS = (
+    ("SEXUALLY_EXPLICIT", 0.65),
+    ("SEVERE_TOXICITY", 0.65),
+    ("THREAT", 0.65),
+    ("IDENTITY_ATTACK", 0.65),
+    ("TOXICITY", 0.65),
+    ("INSULT", 0.7),
+    ("FLIRTATION", 0.65),
+    ("SPAM", 0.75)
+)
+
+# Returns the first rule in `rules` that a set of scores matches, or None if none of them match
+# Attributes missing from the scores (e.g., one Perspective didn't return for a language) count as 0
+def match_rule(scores, rules):
+    for rule in rules:
+        attributes, threshold = rule[0], rule[1]
+        if any(scores.get(attribute, 0) > threshold for attribute in attributes):
+            return rule
+    return None
+
+
+# Pulls the group number out of the bot's name (e.g., "Group 5 Bot")
+GROUP_NAME_RE = re.compile(r"group (\d+) bot", re.IGNORECASE)
 
 # Set up logging to the console
 logger = logging.getLogger('discord')
@@ -36,70 +124,180 @@ handler = logging.FileHandler(filename='discord.log', encoding='utf-8', mode='w'
 handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
 logger.addHandler(handler)
 
-# There should be a file called 'token.json' inside the same folder as this file
-token_path = 'tokens.json'
-if not os.path.isfile(token_path):
-    raise Exception(f"{token_path} not found!")
-with open(token_path) as f:
-    # If you get an error here, it means your token is formatted incorrectly. Did you put it in quotes?
-    tokens = json.load(f)
-    discord_token = tokens['discord']
-    azure_key = tokens["azure"]
-    azure_endpoint = tokens["azure_endpoint"]
+# There should be a file called 'tokens.json' inside the same folder as this file
+# It's only read once here; the Discord token is taken out and the rest are handed to the ContentReviewer
+# If you get an error here, it means your token is formatted incorrectly. Did you put it in quotes?
+tokens = load_tokens('tokens.json')
+discord_token = tokens.pop('discord')
 
 class ModBot(discord.Client, ReactionDelegator):
     smart_spoilers = SMART_SPOILERS
-    def __init__(self):
+    # `tokens` holds the API keys for the ContentReviewer (see content_reviewer.load_tokens)
+    def __init__(self, tokens):
         intents = discord.Intents.default()
         intents.members = True
         super().__init__(intents=intents)
         self.group_num = None   
-        self.flows = {}
-        self.messages_pending_edit = {}
+        self.group_channel_name = None # Name of the "group-#" channel that gets filtered (set once the group number is known)
+        # Map from a user's ID to their open flows, the most recent (the one their DMs go to) last
+        self.flows = defaultdict(deque)
+        # Map from the ID of an edited message that got flagged to its EditedBadMessageFlow
+        self.messages_pending_edit = LRUCache(PENDING_EDIT_CAPACITY)
         self.mod_channels = {} # Map from guild to the mod channel id for that guild
-        self.message_aliases = {}
-        self.message_pairs = {}
-        self.reviewer = ContentReviewer()
+        self.mod_channel_name = None
+        # Map from the ID of a message the bot re-sent (or either of the bot's copies of it) to its ResentMessage
+        # Only the most recent ones are kept so that it doesn't grow forever
+        self.resent_messages = LRUCache(RESENT_MESSAGE_CAPACITY)
+        # Map from a user's ID to the DM channel opened with them, so that it doesn't have to be re-opened with create_dm
+        self.dm_channels = LRUCache(DM_CHANNEL_CAPACITY)
+        # Worker threads for the reviewer's blocking model predictions and hashing, so they never run on the event loop
+        self._review_pool = ThreadPoolExecutor(max_workers=REVIEW_CONCURRENCY)
+        self.reviewer = ContentReviewer(executor=self._review_pool, tokens=tokens)
+        # Map from channel id to the task handling the most recent message in that channel
+        # Each message's task waits on the one before it, so messages stay in order within a channel
+        # while a slow review in one channel doesn't hold up every other channel
+        self._channel_chain = {}
+        # Every message task that hasn't finished yet (not just the last one in each channel), so shutting down can wait on them all
+        self._message_tasks = set()
+        # Set once close starts so that no new messages are picked up while it waits for the old ones
+        self._closing = False
+        # Bounds how many image reviews can be waiting on Azure at once
+        self._review_sem = asyncio.Semaphore(REVIEW_CONCURRENCY)
+        # NCMEC reports get queued up and sent by a background worker so that reporting never holds anything up
+        self._ncmec_queue = asyncio.Queue()
+        self._ncmec_worker = None
+        # The number of channel messages that have been received but not handled yet, and how many had to be dropped
+        self._pending_messages = 0
+        self.dropped_messages = 0
+        # Bounds how many messages are being handled at once
+        self._dispatch_sem = asyncio.Semaphore(MESSAGE_WORKERS)
+        # Bounds how many reports are being sent to mod channels at once
+        self._mod_send_sem = asyncio.Semaphore(MOD_SEND_CONCURRENCY)
 
     async def on_ready(self):
-        print(f'{self.user.name} has connected to Discord! It is in these guilds:')
-        for guild in self.guilds:
-            print(f' - {guild.name}')
-        print('Press Ctrl-C to quit.')
-
         # Parse the group number out of the bot's name
-        match = re.search(r"[gG]roup (\d+) [bB]ot", self.user.name)
+        match = GROUP_NAME_RE.search(self.user.name)
         if match:
             self.group_num = match.group(1)
         else:
             raise Exception("Group number not found in bot's name. Name format should be \"Group # Bot\".")
-        
-        # Find the mod channel in each guild that this bot should report to
+        self.group_channel_name = f'group-{self.group_num}'
+        self.mod_channel_name = f'group-{self.group_num}-mod'
+
+        # List each guild and find the mod channel in it that this bot should report to, all in one pass
+        print(f'{self.user.name} has connected to Discord! It is in these guilds:')
         for guild in self.guilds:
-            for channel in guild.text_channels:
-                if channel.name == f'group-{self.group_num}-mod':
-                    self.mod_channels[guild.id] = channel
+            print(f' - {guild.name}')
+            self.find_mod_channel(guild)
+        print('Press Ctrl-C to quit.')
+
+        # Start the worker that sends out NCMEC reports (on_ready runs again after reconnecting, so only start it once)
+        if self._ncmec_worker is None:
+            self._ncmec_worker = asyncio.ensure_future(self._send_ncmec_reports())
+
+    # Returns the ResentMessage if a message ID belongs to one of the bot's copies of a re-sent message (not the original), or None
+    def resent_copy(self, message_id):
+        resent = self.resent_messages.get(message_id)
+        return resent if resent is not None and resent.original.id != message_id else None
+
+    # Looks up the mod channel for a guild by name and updates mod_channels with it
+    def find_mod_channel(self, guild):
+        channel = discord.utils.get(guild.text_channels, name=self.mod_channel_name)
+        if channel is not None:
+            self.mod_channels[guild.id] = channel
+        else:
+            self.mod_channels.pop(guild.id, None)
+
+    # Keep mod_channels up to date as guilds and channels change after on_ready, instead of only finding them at startup
+    async def on_guild_join(self, guild):
+        self.find_mod_channel(guild)
+
+    async def on_guild_remove(self, guild):
+        self.mod_channels.pop(guild.id, None)
+
+    async def on_guild_channel_create(self, channel):
+        if channel.name == self.mod_channel_name:
+            self.find_mod_channel(channel.guild)
+
+    async def on_guild_channel_delete(self, channel):
+        if self.mod_channels.get(channel.guild.id) == channel:
+            self.find_mod_channel(channel.guild)
+
+    async def on_guild_channel_update(self, before, after):
+        if self.mod_channel_name in (before.name, after.name):
+            self.find_mod_channel(after.guild)
 
     async def on_message(self, message):
         '''
         This function is called whenever a message is sent in a channel that the bot can see (including DMs). 
         Currently the bot is configured to only handle messages that are sent over DMs or in your group's "group-#" channel. 
         '''
-        
-        # Check if this message was sent in a server ("guild") or if it's a DM
+
+        # Messages that come in while the bot is shutting down are ignored, since the review pool is about to go away
+        if self._closing:
+            return
+
+        # Drop channel messages when too many are already waiting so a flood can't grow the backlog forever
+        # DMs are never dropped since they're people talking to the bot directly
         if message.guild:
-            await self.handle_channel_message(message)
-        else:
-            await self.handle_dm(message)
+            if self._pending_messages >= MAX_PENDING_MESSAGES:
+                self.dropped_messages += 1
+                logger.warning(f"Dropped message {message.id} in channel {message.channel.id} ({self.dropped_messages} dropped so far)")
+                return
+            self._pending_messages += 1
+
+        # Chain this message onto the last one sent in the same channel instead of awaiting it here
+        key = message.channel.id
+        prev = self._channel_chain.get(key)
+        task = asyncio.ensure_future(self._run_after(prev, message))
+        self._channel_chain[key] = task
+        self._message_tasks.add(task)
+
+        # Forget about the channel once its last message has been handled
+        def cleanup(finished):
+            if message.guild:
+                self._pending_messages -= 1
+            if self._channel_chain.get(key) is finished:
+                del self._channel_chain[key]
+            self._message_tasks.discard(finished)
+        task.add_done_callback(cleanup)
+
+    # Handles a message once the message before it in the same channel has been handled
+    async def _run_after(self, prev, message):
+        if prev is not None:
+            # Exceptions from the previous message were already logged by its own task
+            await asyncio.wait((prev,))
+
+        try:
+            async with self._dispatch_sem:
+                # Check if this message was sent in a server ("guild") or if it's a DM
+                if message.guild:
+                    await self.handle_channel_message(message)
+                else:
+                    await self.handle_dm(message)
+        except Exception:
+            logger.exception(f"Error while handling message {message.id} in channel {message.channel.id}")
 
     async def on_raw_message_edit(self, payload):
+        # Edits are reviewed with the review pool too, so they're ignored while shutting down like new messages are
+        if self._closing:
+            return
+
         # Try to get the guild ID
         guild_id = payload.data.get("guild_id", None)
         if guild_id is None:
             return
 
+        # Decide from the raw payload whether the edit needs looking at before fetching the whole message
+        # Edits without "content" are Discord adding embeds (like link previews) rather than the user changing anything
+        content = payload.data.get("content")
+        if content is None or payload.data.get("author", {}).get("id") == str(self.user.id):
+            return
+        if payload.message_id not in self.messages_pending_edit and not worth_reviewing(content):
+            return
+
         try:
-            message = await self.get_guild(int(guild_id)).get_channel(payload.channel_id).fetch_message(payload.message_id)
+            message = await self.get_message(self.get_guild(int(guild_id)).get_channel(payload.channel_id), payload.message_id)
         except discord.errors.NotFound:
             # Do nothing for messages that no longer exist
             return
@@ -111,29 +309,15 @@ class ModBot(discord.Client, ReactionDelegator):
         if message.content.strip() == "":
             return
 
-        scores = self.reviewer.review_text(message)
-
-        if payload.message_id in self.messages_pending_edit:
-            return await self.messages_pending_edit[payload.message_id].edited(message)
-
-        if scores["SEXUALLY_EXPLICIT"] > 0.9:
-            return await self.notify_user_edit_message(message, explicit=True, reason=AbuseType.SEXUAL, explanation="as sexually explicit")
-        elif scores["SEVERE_TOXICITY"] > 0.9:
-            return await self.notify_user_edit_message(message, explicit=True, reason=AbuseType.HARASS, explanation="as toxic")
-        elif scores["THREAT"] > 0.9:
-            return await self.notify_user_edit_message(message, explicit=True, reason=AbuseType.VIOLENCE, explanation="as threatening")
-        elif scores["IDENTITY_ATTACK"] > 0.9:
-            return await self.notify_user_edit_message(message, explicit=True, reason=AbuseType.HATEFUL, explanation="as hateful")
-        elif scores["SEXUALLY_EXPLICIT"] > 0.75:
-            return await self.notify_user_edit_message(message, explicit=False, reason=AbuseType.SEXUAL, explanation="as sexually explicit")
-        elif scores["THREAT"] > 0.75:
-            return await self.notify_user_edit_message(message, explicit=False, reason=AbuseType.VIOLENCE, explanation="for inciting violence")
-        elif scores["IDENTITY_ATTACK"] > 0.75:
-            return await self.notify_user_edit_message(message, explicit=False, reason=AbuseType.HATEFUL, explanation="as hateful")
-        elif scores["TOXICITY"] > 0.9 or scores["INSULT"] > 0.9:
-            return await self.notify_user_edit_message(message, explicit=False, reason=AbuseType.HARASS, explanation="as toxic")
-        elif scores["FLIRTATION"] > 0.8:
-            return await self.notify_user_edit_message(message, explicit=False, reason=AbuseType.HARASS, explanation="as flirtation")
+        # A message that was already flagged after an edit is re-checked by its own flow
+        pending_flow = self.messages_pending_edit.get(payload.message_id)
+        if pending_flow is not None:
+            return await pending_flow.edited(message)
+
+        rule = await self.review_edit(message)
+        if rule is not None:
+            _, _, explicit, reason, explanation = rule
+            return await self.notify_user_edit_message(message, explicit=explicit, reason=reason, explanation=explanation)
 
     async def on_raw_reaction_add(self, payload):
         # Do nothing if we are the one adding the reaction
@@ -141,7 +325,7 @@ class ModBot(discord.Client, ReactionDelegator):
             return
 
         # We only care about SOS emojis
-        if payload.emoji.name != "🆘":
+        if payload.emoji.name != SOS_EMOJI:
             return
 
         # If there is no guild_id, do nothing
@@ -152,23 +336,40 @@ class ModBot(discord.Client, ReactionDelegator):
         try:
             guild = self.get_guild(int(guild_id))
             channel = guild.get_channel(payload.channel_id)
-            message = await channel.fetch_message(payload.message_id)
+            message = await self.get_message(channel, payload.message_id)
         except discord.errors.NotFound:
             # Do nothing for messages that no longer exist
             return
 
-        member = guild.get_member(payload.user_id)
+        # Reactions in guilds come with the member who reacted
+        member = payload.member or guild.get_member(payload.user_id)
 
-        await message.remove_reaction("🆘", member)
-
-        await self.ensure_dm_channel(member)
-        self.flows[payload.user_id] = self.flows.get(payload.user_id, [])
+        # Removing their reaction and opening a DM with them don't depend on each other, so do both at once
+        await asyncio.gather(
+            message.remove_reaction(SOS_EMOJI, member),
+            self.ensure_dm_channel(member)
+        )
         self.flows[payload.user_id].append(SOSFlow(
             client=self,
             message=message,
-            user=guild.get_member(payload.user_id)
+            user=member
         ))
 
+    # Gets a message from the client's message cache, only fetching it from Discord if it isn't cached
+    # Raises discord.errors.NotFound if the message no longer exists
+    async def get_message(self, channel, message_id):
+        # payload.cached_message on raw edits is a copy from *before* the edit, so look up the cached message itself (which is up to date)
+        message = discord.utils.get(self.cached_messages, id=message_id)
+        return message if message is not None else await channel.fetch_message(message_id)
+
+    # Reviews an edited message's text and returns the first rule in TEXT_RULES it matches (or None if it's fine)
+    # This is shared with EditedBadMessageFlow so that re-edits of a flagged message are held to the same rules
+    async def review_edit(self, message):
+        # Skip reviewing messages that are too short (or only links) to be flagged
+        if not worth_reviewing(message.content):
+            return None
+        return match_rule(await self.reviewer.review_text(message), TEXT_RULES)
+
     async def notify_user_edit_message(self, message, explicit=False, reason=None, explanation=None):
         await self.ensure_dm_channel(message.author)
         flow = EditedBadMessageFlow(
@@ -178,8 +379,7 @@ class ModBot(discord.Client, ReactionDelegator):
             reason=reason,
             explanation=explanation
         )
-        self.messages_pending_edit[message.id] = flow
-        self.flows[message.author.id] = self.flows.get(message.author.id, [])
+        self.messages_pending_edit.put(message.id, flow)
         self.flows[message.author.id].append(flow)
 
     async def handle_dm(self, message):
@@ -193,29 +393,23 @@ class ModBot(discord.Client, ReactionDelegator):
         responses = []
 
         # Ensure there is a DM channel between us and the user (which there should be since we are handling a DM message, but just in case)
-        message.author.dm_channel or await message.author.create_dm()
+        await self.ensure_dm_channel(message.author)
 
-        # Handle smart_spoilers
-        if content.lower() == ".debug smart_spoilers toggle":
-            self.smart_spoilers = not self.smart_spoilers
-            await message.channel.send(embed=discord.Embed(description=f"Smart spoilers have been {'enabled' if self.smart_spoilers else 'disabled'}."))
-            return
-        if content.lower() == ".debug smart_spoilers enable":
-            self.smart_spoilers = True
-            await message.channel.send(embed=discord.Embed(description="Smart spoilers have been enabled."))
-            return
-        if content.lower() == ".debug smart_spoilers disable":
-            self.smart_spoilers = False
-            await message.channel.send(embed=discord.Embed(description="Smart spoilers have been disabled."))
+        # The message is only casefolded once for every command check below
+        # (casefold is like lower, but also matches non-ASCII text case-insensitively)
+        lowered = content.casefold()
+
+        # Handle smart_spoilers (anything else starting with .debug falls through like any other message)
+        if lowered.startswith(SMART_SPOILERS_PREFIX) and await self.debug_smart_spoilers(message, lowered[len(SMART_SPOILERS_PREFIX):].strip()):
             return
 
-        if len(self.flows.get(message.author.id, [])):
-            return await self.flows[message.author.id][-1].forward_message(message)
+        user_flows = self.flows.get(author_id)
+        if user_flows:
+            return await user_flows[-1].forward_message(message)
 
         # Handle a report message
-        if content.lower() in START_KEYWORDS:
+        if lowered in START_KEYWORDS:
             # Start a new UserReportCreationFlow
-            self.flows[message.author.id] = self.flows.get(message.author.id, [])
             self.flows[message.author.id].append(UserReportCreationFlow(
                 client=self,
                 reporter=message.author
@@ -228,19 +422,46 @@ class ModBot(discord.Client, ReactionDelegator):
         if FILTER_DMS:
             await self.handle_channel_message(message)
 
+    # .debug smart_spoilers enable/disable/toggle
+    # Returns True if it handled the message
+    async def debug_smart_spoilers(self, message, arg):
+        if arg not in SMART_SPOILERS_COMMANDS:
+            return False
+        value = SMART_SPOILERS_COMMANDS[arg]
+        self.smart_spoilers = not self.smart_spoilers if value is None else value
+        await message.channel.send(embed=discord.Embed(description=f"Smart spoilers have been {'enabled' if self.smart_spoilers else 'disabled'}."))
+        return True
+
     async def handle_channel_message(self, message):
         # Only handle messages sent in the "group-#" channel or DMs
-        if not (FILTER_DMS and isinstance(message.channel, discord.DMChannel)) and message.channel.name != f'group-{self.group_num}':
+        if not (FILTER_DMS and isinstance(message.channel, discord.DMChannel)) and message.channel.name != self.group_channel_name:
            return
 
         addedReaction = False
 
-        # If the message that was sent is from us (the bot), don't filter
-        if message.author.id != self.user.id:
+        # Messages from bots (including us) aren't filtered, so they never cost a Perspective or Azure request
+        if not message.author.bot:
             # First filter through images since those are more likely to be seen than text
             if len(message.attachments) > 0:
                 # Analyze all the attachments of a message
-                scores_list = await self.reviewer.review_images(message)
+                async with self._review_sem:
+                    scores_list = await self.reviewer.review_images(message)
+
+                # Go through every attachment's scores once, keeping track of whether any of them matched a CSAM hash,
+                # the maximum score of each category, and which attachments are a 73% match for CSAM
+                hash_matched = False
+                max_scores = {}
+                csam_messages = []
+                csam_scores = []
+                for attachment, scores in zip(message.attachments, scores_list):
+                    if scores["CSAM_HASH"]:
+                        hash_matched = True
+                    if scores["CSAM_HASH"] or scores["CSAM"] > 0.73:
+                        csam_messages.append(attachment)
+                        csam_scores.append(scores)
+                    for key, value in scores.items():
+                        if key not in max_scores or value > max_scores[key]:
+                            max_scores[key] = value
 
                 # If a message is found to be a 73% match for CSAM, we will tell the user that their message was
                 # flagged as sexually suggestive and ask if they really want to send it, siomilar to the normal flow
@@ -258,21 +479,12 @@ class ModBot(discord.Client, ReactionDelegator):
                 # First, we do all the other scanning and send a warning as usual for that.
                 # If one of the images matches a hash however, we skip straight to banning the user and removing their image.
                 flaggedByOther = False
-                if not any(scores["CSAM_HASH"] for scores in scores_list):
-                    # Make an object that has the maximum score of each category for the attachments
-                    max_scores = {}
-                    for scores in scores_list:
-                        for key in scores:
-                            max_scores[key] = max(max_scores.get(key, 0), scores[key])
-
-                    if max_scores["ADULT"] > 0.85:
-                        await self.confirm_user_message(message, explicit=True, abuse_type=AbuseType.SEXUAL, explanation="for having a sexually explicit image")
-                        flaggedByOther = True
-                    elif max_scores["GORE"] > 0.75:
-                        await self.confirm_user_message(message, explicit=True, abuse_type=AbuseType.VIOLENCE, explanation="as promoting violence for having a bloody/gory image")
-                        flaggedByOther = True
-                    elif max_scores["RACY"] > 0.8:
-                        await self.confirm_user_message(message, explicit=True, abuse_type=AbuseType.SEXUAL, explanation="as having a sexually suggestive image")
+                if not hash_matched:
+                    # Flag the images with the first rule they match (see IMAGE_RULES)
+                    rule = match_rule(max_scores, IMAGE_RULES)
+                    if rule is not None:
+                        _, _, explicit, abuse_type, explanation = rule
+                        await self.confirm_user_message(message, explicit=explicit, abuse_type=abuse_type, explanation=explanation)
                         flaggedByOther = True
                 else:
                     try:
@@ -282,9 +494,7 @@ class ModBot(discord.Client, ReactionDelegator):
                         pass
 
                 # Now we do scanning for CSAM.
-
-                # Get a list of messages that are a 73% match for CSAM, and their corresponding scores.
-                csam_messages, csam_scores = tuple(zip(*((message.attachments[i], scores_list[i]) for i in range(len(message.attachments)) if scores_list[i]["CSAM"] > 0.73 or scores_list[i]["CSAM_HASH"]))) or ((), ())
+                # The attachments that are a 73% match for CSAM, and their corresponding scores, were collected above.
 
                 # Now, we will send a CSAM report to the mod channel no matter what.
                 # If their message has already been flagged for something else, we will not show another warning.
@@ -296,44 +506,29 @@ class ModBot(discord.Client, ReactionDelegator):
                 if flaggedByOther:
                     return
 
-            # Now analyze the message's textual content
-            if len(message.content.strip()) > 0:
-                scores = self.reviewer.review_text(message)
-
-                # Explicit message
-                if scores["SEXUALLY_EXPLICIT"] > 0.9:
-                    return await self.confirm_user_message(message, explicit=True, abuse_type=AbuseType.SEXUAL, explanation="as sexually explicit")
-                elif scores["SEVERE_TOXICITY"] > 0.9:
-                    return await self.confirm_user_message(message, explicit=True, abuse_type=AbuseType.HARASS, explanation="as toxic")
-                elif scores["THREAT"] > 0.9:
-                    return await self.confirm_user_message(message, explicit=True, abuse_type=AbuseType.VIOLENCE, explanation="as threatening")
-                elif scores["IDENTITY_ATTACK"] > 0.9:
-                    return await self.confirm_user_message(message, explicit=True, abuse_type=AbuseType.HATEFUL, explanation="as hateful")
-                # Non-explicit messages
-                elif scores["SEXUALLY_EXPLICIT"] > 0.75:
-                    return await self.confirm_user_message(message, explicit=False, abuse_type=AbuseType.SEXUAL, explanation="as sexually explicit")
-                elif scores["THREAT"] > 0.75:
-                    return await self.confirm_user_message(message, explicit=False, abuse_type=AbuseType.VIOLENCE, explanation="for inciting violence")
-                elif scores["IDENTITY_ATTACK"] > 0.75:
-                    return await self.confirm_user_message(message, explicit=False, abuse_type=AbuseType.HATEFUL, explanation="as hateful")
-                elif scores["TOXICITY"] > 0.9 or scores["INSULT"] > 0.9:
-                    return await self.confirm_user_message(message, explicit=False, abuse_type=AbuseType.HARASS, explanation="as toxic")
-                elif scores["FLIRTATION"] > 0.8:
-                    return await self.confirm_user_message(message, explicit=False, abuse_type=AbuseType.HARASS, explanation="as flirtation")
-                elif scores["SPAM"] > 0.9:
-                    return await self.confirm_user_message(message, explicit=False, abuse_type=AbuseType.SPAM, explanation="as spam")
+            # Now analyze the message's textual content (skipping messages that are too short or only links)
+            if worth_reviewing(message.content):
+                scores = await self.reviewer.review_text(message)
+
+                # Flag the message with the first rule it matches (see TEXT_RULES)
+                rule = match_rule(scores, MESSAGE_TEXT_RULES)
+                if rule is not None:
+                    _, _, explicit, abuse_type, explanation = rule
+                    return await self.confirm_user_message(message, explicit=explicit, abuse_type=abuse_type, explanation=explanation)
                 # Uncertain textual message get an SOS
-                elif scores["SEXUALLY_EXPLICIT"] > 0.65 or scores["SEVERE_TOXICITY"] > 0.65 or scores["THREAT"] > 0.65 or scores["IDENTITY_ATTACK"] > 0.65 or scores["TOXICITY"] > 0.65 or scores["INSULT"] > 0.7 or scores["FLIRTATION"] > 0.65 or scores["SPAM"] > 0.75:
-                    await message.add_reaction("🆘")
+                elif any(scores.get(attribute, 0) > threshold for attribute, threshold in SOS_THRESHOLDS):
+                    await message.add_reaction(SOS_EMOJI)
                     addedReaction = True
 
         # If a message includes any attachments, an SOS is automatically added no matter what since attachments are so hard to scan for
         if len(message.attachments) > 0 and not addedReaction:
-            await message.add_reaction("🆘")
+            await message.add_reaction(SOS_EMOJI)
 
     async def mark_as_csam(self, message, images, scores, show_warning):
         # If show_warning is disabled, then the message has already been flagged for something else and the message has already been deleted
         message_deleted = not show_warning
+        # Images that aren't in our database each get their own report in the mod channel, which are all sent together below
+        reported = []
         for i in range(len(images)):
             # If this image is in our database as a flagged image, report it to NCMEC automatically
             if scores[i]["CSAM_HASH"]:
@@ -353,14 +548,14 @@ class ModBot(discord.Client, ReactionDelegator):
                 continue
 
             # A report will be sent to the mod channel for this individual image
-            report = await CSAMImageReport(
-                client=self,
-                message=message,
-                image=images[i],
-                score=scores[i]["CSAM"]
-            )
+            reported.append((images[i], scores[i]["CSAM"]))
 
-            await asyncio.gather(*(report.send_to_channel(channel, assignable=True) for channel in self.mod_channels.values()))
+        # Create and send the report for each image in parallel instead of one after another
+        report_sem = asyncio.Semaphore(REPORT_CONCURRENCY)
+        async def send_report(image, score):
+            async with report_sem:
+                await self.send_csam_report(message, image, score)
+        await asyncio.gather(*(send_report(image, score) for image, score in reported))
 
         # If show warning is on, we will send the user a dummy warning telling them that their image was marked as sexually suggestive
         # This is the same as normal, except a report will not be generated if they select yes because we already sent a report for each image
@@ -375,22 +570,58 @@ class ModBot(discord.Client, ReactionDelegator):
                 message=message
             )
 
-            self.flows[message.author.id] = self.flows.get(message.author.id, [])
             self.flows[message.author.id].append(flow)
 
+    # Creates a CSAMImageReport for a single image and sends it to every mod channel
+    async def send_csam_report(self, message, image, score):
+        report = await CSAMImageReport(
+            client=self,
+            message=message,
+            image=image,
+            score=score
+        )
+
+        await self.send_to_mod_channels(report)
+
+    # Sends a report to every mod channel, with at most MOD_SEND_CONCURRENCY sends going at once (see _mod_send_sem)
+    # A channel that fails (e.g., from being rate limited) is logged without stopping the report from reaching the others
+    async def send_to_mod_channels(self, report, assignable=True):
+        async def send(channel):
+            async with self._mod_send_sem:
+                return await report.send_to_channel(channel, assignable=assignable)
+
+        channels = list(self.mod_channels.values())
+        results = await asyncio.gather(*(send(channel) for channel in channels), return_exceptions=True)
+        for channel, result in zip(channels, results):
+            if isinstance(result, Exception):
+                logger.error(f"Failed to send a {type(report).__name__} to channel {channel.id}", exc_info=result)
+
     def report_ncmec(self, user, image):
-        # This is supposed to mimic us sending a report to NCMEC, which we of course can't ACTUALLY do
-        print(f"A report was sent to NCMEC with {user.display_name}'s information for the image at {image.proxy_url}.")
+        # Queue the report to be sent by _send_ncmec_reports so the caller doesn't have to wait on it
+        self._ncmec_queue.put_nowait((user, image))
+
+    # Background worker that sends each queued NCMEC report
+    async def _send_ncmec_reports(self):
+        while True:
+            user, image = await self._ncmec_queue.get()
+            try:
+                # This is supposed to mimic us sending a report to NCMEC, which we of course can't ACTUALLY do
+                print(f"A report was sent to NCMEC with {user.display_name}'s information for the image at {image.proxy_url}.")
+            except Exception:
+                logger.exception(f"Failed to send an NCMEC report for the image at {image.proxy_url}")
+            finally:
+                self._ncmec_queue.task_done()
 
     async def confirm_user_message(self, message, always_report=False, explicit=False, abuse_type=None, explanation="", urgency=None):
         # DMs a user asking if they are sure they want to send a message
 
         # The message first gets auto-deleted by the bot
         # We cannot delete a mesasge from DMs though
+        # Deleting it and opening a DM channel with the author are independent requests, so they're done at the same time
         if not isinstance(message.channel, discord.DMChannel):
-            await message.delete()
-
-        await self.ensure_dm_channel(message.author)
+            await asyncio.gather(message.delete(), self.ensure_dm_channel(message.author))
+        else:
+            await self.ensure_dm_channel(message.author)
         flow = SentBadMessageFlow(
             client=self,
             message=message,
@@ -401,16 +632,61 @@ class ModBot(discord.Client, ReactionDelegator):
             urgency=urgency
         )
 
-        self.flows[message.author.id] = self.flows.get(message.author.id, [])
         self.flows[message.author.id].append(flow)
 
+    # Returns the DM channel with a user, opening one first (a REST request) only if it isn't already known
     async def ensure_dm_channel(self, user):
-        return user.dm_channel or await user.create_dm()
-
-    async def on_disconnect(self):
-        # Closes the csam.hashlist file when the bot disconnects (which is essentually never because we Ctrl+C to kill it instead of doing it the right way...)
-        for file in self.reviewer.hashlists.values():
-            file.close()
-
-client = ModBot()
+        channel = self.dm_channel(user)
+        if channel is None:
+            channel = await user.create_dm()
+        self.dm_channels.put(user.id, channel)
+        return channel
+
+    # Returns the DM channel with a user if one has been opened, or None if there isn't one yet
+    def dm_channel(self, user):
+        return self.dm_channels.get(user.id) or user.dm_channel
+
+    # DMs a user, opening a DM channel with them first if there isn't one yet
+    # This is a single coroutine so it can be gathered with other requests
+    async def send_dm(self, user, *args, **kwargs):
+        return await (await self.ensure_dm_channel(user)).send(*args, **kwargs)
+
+    # Gives the messages still being handled up to MESSAGE_DRAIN_TIMEOUT seconds to finish, then cancels the rest
+    async def _drain_channel_messages(self):
+        if not self._message_tasks:
+            return
+        _, pending = await asyncio.wait(tuple(self._message_tasks), timeout=MESSAGE_DRAIN_TIMEOUT)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    # Gives the NCMEC worker up to NCMEC_DRAIN_TIMEOUT seconds to send the reports still in its queue, then stops it
+    # Any reports that still haven't been sent are logged so they aren't lost without a trace
+    async def _drain_ncmec_reports(self):
+        if self._ncmec_worker is not None:
+            try:
+                await asyncio.wait_for(self._ncmec_queue.join(), NCMEC_DRAIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+            self._ncmec_worker.cancel()
+        while not self._ncmec_queue.empty():
+            user, image = self._ncmec_queue.get_nowait()
+            logger.error(f"Shut down before sending an NCMEC report with {user.display_name}'s information for the image at {image.proxy_url}")
+
+    # Cleans up everything the bot started on top of discord.Client when it shuts down (including on Ctrl+C through client.run)
+    # This isn't done in on_disconnect since that also fires for every gateway reconnect, when the HTTP session and workers should be kept
+    async def close(self):
+        self._closing = True
+        # Messages still being handled can queue NCMEC reports and use the review pool, so they're finished (or cancelled) first
+        await self._drain_channel_messages()
+        await self._drain_ncmec_reports()
+        # Wait for reviews still running in the pool to finish before the reviewer's final flush, so nothing they save
+        # (like a new hashlist entry) is left unwritten; the wait happens in another thread to keep the event loop free
+        await asyncio.get_running_loop().run_in_executor(None, self._review_pool.shutdown)
+        await self.reviewer.close()
+        await super().close()
+
+client = ModBot(tokens)
+# The reviewer has kept the keys it needs, so the parsed file doesn't have to stick around as a global
+del tokens
 client.run(discord_token)
\ No newline at end of file
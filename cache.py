@@ -0,0 +1,149 @@
+import sqlite3
+import threading
+from collections import OrderedDict
+from time import time
+
+# A fixed-size cache that evicts the least frequently used entry when it fills up
+# Ties between entries used the same number of times are broken by evicting the least recently used one
+# Every operation is O(1): entries are grouped by how many times they've been used, and each group is kept in LRU order
+class LFUCache():
+    def __init__(self, capacity):
+        self.capacity = capacity
+        # Map from key to [value, use count]
+        self.entries = {}
+        # Map from use count to the keys with that count (oldest first)
+        self.frequencies = {}
+        self.min_frequency = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    # Returns the value stored for `key` (counting it as a use), or `default` if it isn't cached
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+        self._touch(key, entry)
+        return entry[0]
+
+    # Stores a value for `key`, evicting the least frequently used entry if the cache is full
+    def put(self, key, value):
+        if self.capacity <= 0:
+            return
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry[0] = value
+            self._touch(key, entry)
+            return
+        if len(self.entries) >= self.capacity:
+            evicted, _ = self.frequencies[self.min_frequency].popitem(last=False)
+            if not self.frequencies[self.min_frequency]:
+                del self.frequencies[self.min_frequency]
+            del self.entries[evicted]
+        self.entries[key] = [value, 1]
+        self.frequencies.setdefault(1, OrderedDict())[key] = None
+        self.min_frequency = 1
+
+    # Moves a key up to the next use count
+    def _touch(self, key, entry):
+        frequency = entry[1]
+        keys = self.frequencies[frequency]
+        del keys[key]
+        if not keys:
+            del self.frequencies[frequency]
+            if self.min_frequency == frequency:
+                self.min_frequency = frequency + 1
+        entry[1] = frequency + 1
+        self.frequencies.setdefault(frequency + 1, OrderedDict())[key] = None
+
+# A fixed-size cache that evicts the least recently used entry when it fills up
+class LRUCache():
+    def __init__(self, capacity):
+        self.capacity = capacity
+        # Map from key to value, least recently used first
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    # Returns the value stored for `key` (marking it as recently used), or `default` if it isn't cached
+    def get(self, key, default=None):
+        if key not in self.entries:
+            return default
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    # Stores a value for `key`, evicting the least recently used entries if the cache is full
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    # Removes `key` from the cache and returns its value, or `default` if it isn't cached
+    def pop(self, key, default=None):
+        return self.entries.pop(key, default)
+
+# A key-value store kept on disk in a SQLite database so that cached values survive restarts
+# Keys and values are bytes; writes are held in memory and committed together once `batch_size` of them pile up
+# (or flush is called), and entries older than `max_age` seconds are dropped whenever the database is opened
+# Its methods do blocking disk I/O, so they're meant to be called from executor threads; a lock keeps those threads from
+# using the connection (and the pending writes) at the same time
+class SQLiteCache():
+    def __init__(self, path, batch_size=100, max_age=None):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        # Write-ahead logging lets reads go on while a batch is being committed, and NORMAL sync skips an fsync per commit
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS cache (key BLOB PRIMARY KEY, value BLOB NOT NULL, time INTEGER NOT NULL)")
+        if max_age is not None:
+            with self.db:
+                self.db.execute("DELETE FROM cache WHERE time < ?", (int(time() - max_age),))
+        self.batch_size = batch_size
+        # Writes that haven't been committed yet
+        self.pending = {}
+
+    # Returns the value stored for `key`, or `default` if there isn't one
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.pending:
+                return self.pending[key]
+            row = self.db.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+        return default if row is None else row[0]
+
+    # Stores a value for `key`, committing it along with the other pending writes once there are enough of them
+    def put(self, key, value):
+        with self.lock:
+            self.pending[key] = value
+            if len(self.pending) >= self.batch_size:
+                self._commit_pending()
+
+    # Commits all the pending writes in one transaction
+    def flush(self):
+        with self.lock:
+            self._commit_pending()
+
+    # Does the work of flush for a caller that's already holding the lock
+    def _commit_pending(self):
+        if not self.pending:
+            return
+        now = int(time())
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO cache (key, value, time) VALUES (?, ?, ?)",
+                ((key, value, now) for key, value in self.pending.items())
+            )
+        self.pending.clear()
+
+    # Commits any pending writes and closes the database
+    def close(self):
+        with self.lock:
+            self._commit_pending()
+            self.db.close()
\ No newline at end of file
@@ -4,13 +4,25 @@ import cv2
 from skimage import exposure
 from sklearn.model_selection import train_test_split
 import numpy as np
+import tensorflow as tf
 from keras.models import Sequential
-from keras.utils.np_utils import to_categorical
 from keras.layers.convolutional import Conv2D, Cropping2D
 from keras.layers import Dense, Dropout, Activation, Flatten, ELU
 
 GRAYSCALE = False
 
+# The number of images in each training batch
+BATCH_SIZE = 32
+# Whether decoded images are kept in memory after the first epoch so that later epochs don't decode them again
+# (turn this off for datasets too big to fit in memory)
+CACHE_IMAGES = True
+# Whether to train with mixed precision (float16 math with float32 weights) when there's a GPU to train on
+# This roughly doubles throughput on GPUs with tensor cores, but only slows down training on a CPU
+MIXED_PRECISION = True
+
+# Random numbers for sampling and splitting the data (pass a seed to make runs reproducible)
+RNG = np.random.default_rng()
+
 def rotateImage(img, angle):
     if GRAYSCALE:
         rows, cols = img.shape
@@ -26,40 +38,58 @@ def loadBlurImg(path, imgSize):
     img = cv2.resize(img, imgSize)
     return img
 
-def loadImgClass(classPath, classLabel, classSize, imgSize):
-    x = []
-    y = []
-
+# Picks exactly `classSize` paths out of `classPath` (as a numpy array)
+# Random indices are picked rather than the paths themselves, so no lists of paths get copied around
+def sampleClass(classPath, classSize):
+    classPath = np.asarray(classPath)
     # Undersampling
     if len(classPath) > classSize:
-        classPath = np.random.choice(classPath, size=classSize, replace=False)
-    # Oversampling
+        return classPath[RNG.choice(len(classPath), size=classSize, replace=False)]
+    # Oversampling (every path is kept, and random ones are repeated to make up the difference)
     elif len(classPath) < classSize:
-        classPath = classPath + list(np.random.choice(classPath, size=classSize - len(classPath), replace=True))
-    
-    for path in classPath:
-        img = loadBlurImg(path, imgSize)
-        x.append(img)
-        y.append(classLabel)
+        return classPath[np.concatenate((np.arange(len(classPath)), RNG.integers(len(classPath), size=classSize - len(classPath))))]
+    return classPath
 
-    return x, y
-
-def loadData(img_size, classSize):
+# Finds the images to train on and their labels, without loading any of them yet (see makeDataset)
+def loadData(classSize):
     hotdogs = glob.glob('./data/hotdog/**/*.jpg', recursive=True)
     notHotdogs = glob.glob('./data/not-hotdog/**/*.jpg', recursive=True)
-    
-    imgSize = (img_size, img_size)
-    print(f"Loading {classSize} hotdogs from {len(hotdogs)} images")
-    xHotdog, yHotdog = loadImgClass(hotdogs, 0, classSize, imgSize)
-    print(f"Loading {classSize} not-hotdogs from {len(notHotdogs)} images")
-    xNotHotdog, yNotHotdog = loadImgClass(notHotdogs, 1, classSize, imgSize)
-    print(f"There are now {len(xHotdog)} hotdogs")
-    print(f"There are now {len(xNotHotdog)} not-hotdogs")
-
-    X = np.array(xHotdog + xNotHotdog)
-    y = np.array(yHotdog + yNotHotdog)
-    
-    return X, y
+
+    print(f"Sampling {classSize} hotdogs from {len(hotdogs)} images")
+    hotdogs = sampleClass(hotdogs, classSize)
+    print(f"Sampling {classSize} not-hotdogs from {len(notHotdogs)} images")
+    notHotdogs = sampleClass(notHotdogs, classSize)
+
+    paths = np.concatenate((hotdogs, notHotdogs))
+    y = np.repeat(np.array([0, 1], dtype=np.uint8), (len(hotdogs), len(notHotdogs)))
+
+    return paths, y
+
+# Builds a tf.data pipeline that loads the images at `paths` batch by batch as training needs them
+# Images are decoded on several threads at once (cv2 releases the GIL) while the model trains on the batch before,
+# instead of every image being decoded into memory before training can start
+def makeDataset(paths, y, imgSize, nClasses, shuffle=False):
+    shape = imgSize + (1 if GRAYSCALE else 3,)
+
+    def loadImg(path):
+        return np.reshape(loadBlurImg(path.decode("utf-8"), imgSize), shape)
+
+    def loadExample(path, label):
+        img = tf.numpy_function(loadImg, [path], tf.uint8)
+        img.set_shape(shape)
+        return img, label
+
+    dataset = tf.data.Dataset.from_tensor_slices((paths, y)).map(loadExample, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    # Images are cached as uint8 (before being converted to floats) to keep the cache small
+    # They're converted to the dtype the model computes in (float16 with mixed precision) so they don't need converting again
+    if CACHE_IMAGES:
+        dataset = dataset.cache()
+    if shuffle:
+        dataset = dataset.shuffle(len(paths))
+    return dataset.batch(BATCH_SIZE).map(
+        lambda img, label: (tf.cast(img, tf.keras.mixed_precision.global_policy().compute_dtype), tf.one_hot(label, nClasses)),
+        num_parallel_calls=tf.data.experimental.AUTOTUNE
+    ).prefetch(tf.data.experimental.AUTOTUNE)
 
 def kerasModel(inputShape):
     model = Sequential()
@@ -75,7 +105,8 @@ def kerasModel(inputShape):
     model.add(Dropout(.5))
     model.add(ELU())
     model.add(Dense(2))
-    model.add(Activation("sigmoid"))
+    # The output is always float32 so that the loss is computed accurately even when training with mixed precision
+    model.add(Activation("sigmoid", dtype="float32"))
     return model
 
 def main():
@@ -92,34 +123,37 @@ def main():
     # The number of images to generate for each class
     CLASS_SIZE = 3000
 
-    scaled_X, y = loadData(IMG_SIZE, CLASS_SIZE)
+    # This has to be set before the model is built
+    # (compile then wraps the optimizer to scale the loss so that small float16 gradients don't underflow)
+    if MIXED_PRECISION and tf.config.list_physical_devices("GPU"):
+        tf.keras.mixed_precision.set_global_policy("mixed_float16")
 
-    n_classes = len(np.unique(y))
+    paths, y = loadData(CLASS_SIZE)
 
-    y = to_categorical(y)
+    n_classes = len(np.unique(y))
 
-    rand_state = np.random.randint(0, 100)
+    rand_state = int(RNG.integers(100))
 
     print("Splitting data")
-    X_train, X_test, y_train, y_test = train_test_split(scaled_X, y, test_size=0.2, random_state=rand_state)
+    paths_train, paths_test, y_train, y_test = train_test_split(paths, y, test_size=0.2, random_state=rand_state)
+    # 10% of the training images are held out for validation
+    paths_train, paths_val, y_train, y_val = train_test_split(paths_train, y_train, test_size=0.1, random_state=rand_state)
 
-    if GRAYSCALE:
-        inputShape = (IMG_SIZE, IMG_SIZE, 1)
-        X_train = np.expand_dims(X_train, 3)
-        X_test = np.expand_dims(X_test, 3)
-    else:
-        inputShape = (IMG_SIZE, IMG_SIZE, 3)
+    imgSize = (IMG_SIZE, IMG_SIZE)
+    inputShape = imgSize + (1 if GRAYSCALE else 3,)
+    train = makeDataset(paths_train, y_train, imgSize, n_classes, shuffle=True)
+    validation = makeDataset(paths_val, y_val, imgSize, n_classes)
+    test = makeDataset(paths_test, y_test, imgSize, n_classes)
 
     print("Number of classes =", n_classes)
-    print("train shape X", X_train.shape)
-    print("train shape y", y_train.shape)
+    print("train size", len(paths_train))
 
     model = kerasModel(inputShape)
 
     model.compile("adam", "binary_crossentropy", ["accuracy"])
-    history = model.fit(X_train, y_train, epochs=10, validation_split=0.1)
+    history = model.fit(train, epochs=10, validation_data=validation)
 
-    metrics = model.evaluate(X_test, y_test)
+    metrics = model.evaluate(test)
     for metric_i in range(len(model.metrics_names)):
         metric_name = model.metrics_names[metric_i]
         metric_value = metrics[metric_i]
@@ -0,0 +1,39 @@
+import sys
+import numpy as np
+import tensorflow as tf
+from keras.models import load_model
+from build import GRAYSCALE, loadData, loadBlurImg
+
+# Size the model's input images are resized to (the same as in build.py)
+IMG_SIZE = 128
+# The number of training images of each class that are run through the model to calibrate its int8 ranges
+CALIBRATION_CLASS_SIZE = 50
+
+# Yields the calibration images one at a time, prepared the same way as they are for training
+def representativeData(paths):
+    shape = (1, IMG_SIZE, IMG_SIZE, 1 if GRAYSCALE else 3)
+    for path in paths:
+        yield [np.reshape(loadBlurImg(path, (IMG_SIZE, IMG_SIZE)), shape).astype(np.float32)]
+
+def main():
+    MODEL_NAME = sys.argv[1] if len(sys.argv) > 1 else "model.h5"
+    if len(sys.argv) > 2:
+        OUTPUT_NAME = sys.argv[2]
+    else:
+        OUTPUT_NAME = (MODEL_NAME[:-3] if MODEL_NAME[-3:] == ".h5" else MODEL_NAME) + ".tflite"
+
+    paths, _ = loadData(CALIBRATION_CLASS_SIZE)
+
+    # The weights and activations are quantized to int8 wherever TFLite supports it (anything else stays float)
+    # The input and output stay float32, so the bot feeds the quantized model the same images as the .h5 model
+    converter = tf.lite.TFLiteConverter.from_keras_model(load_model(MODEL_NAME, compile=False))
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = lambda: representativeData(paths)
+
+    with open(OUTPUT_NAME, "wb") as file:
+        file.write(converter.convert())
+
+    print(f"Saved quantized model to {OUTPUT_NAME}")
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -1,10 +1,14 @@
 from enum import Enum, auto
 
-HELP_KEYWORDS = ("help", "?")
-CANCEL_KEYWORDS = ("cancel", "quit", "exit")
-START_KEYWORDS = ("report",)
-YES_KEYWORDS = ("yes", "y", "yeah", "yup", "sure")
-NO_KEYWORDS = ("no", "n", "nah", "naw", "nope")
+# Keywords are frozensets (all lowercase) so checking a reply against them is a single hash lookup
+HELP_KEYWORDS = frozenset(("help", "?"))
+CANCEL_KEYWORDS = frozenset(("cancel", "quit", "exit"))
+START_KEYWORDS = frozenset(("report",))
+YES_KEYWORDS = frozenset(("yes", "y", "yeah", "yup", "sure"))
+NO_KEYWORDS = frozenset(("no", "n", "nah", "naw", "nope"))
+
+# The reaction used to flag uncertain messages and to start the SOS flow
+SOS_EMOJI = "🆘"
 
 class AbuseType(Enum):
     SPAM      = "Misinformation or Spam"
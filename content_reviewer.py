@@ -1,170 +1,630 @@
 import sys
 import os.path
+import asyncio
 import json
-import requests
+import logging
+import re
+import threading
+import uuid
+from hashlib import blake2b
+from time import monotonic
+import aiohttp
 from io import BytesIO
 
 from PIL import Image
-from imagehash import dhash as difference_hash
 import cv2
 
 import numpy as np
+import tensorflow as tf
 from keras.models import load_model
 
-from azure.cognitiveservices.vision.computervision import ComputerVisionClient
-from msrest.authentication import CognitiveServicesCredentials
+# orjson is used for HTTP request and response bodies when it's installed since it's several times faster than json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from cache import LFUCache, SQLiteCache
+from hashlist import HashList
 
 TOKEN_PATH = "tokens.json"
 
+PERSPECTIVE_HOST = "https://commentanalyzer.googleapis.com"
+PERSPECTIVE_ANALYZE_PATH = "/v1alpha1/comments:analyze"
+PERSPECTIVE_URL = PERSPECTIVE_HOST + PERSPECTIVE_ANALYZE_PATH
+# The part of a Perspective analyze request that's the same for every text (see PERSPECTIVE_BODY_SUFFIX)
+PERSPECTIVE_TEMPLATE = {
+    'languages': ['en'],
+    'requestedAttributes': {
+        'SEVERE_TOXICITY': {},
+        'IDENTITY_ATTACK': {},
+        'INSULT': {},
+        'THREAT': {},
+        'TOXICITY': {},
+        'SPAM': {},
+        'SEXUALLY_EXPLICIT': {},
+        'FLIRTATION': {}
+    },
+    'doNotStore': True
+}
+PERSPECTIVE_ATTRS = tuple(PERSPECTIVE_TEMPLATE['requestedAttributes'])
+# Google's HTTP batch endpoint for Perspective, which takes many analyze requests in one multipart/mixed request
+PERSPECTIVE_BATCH_URL = PERSPECTIVE_HOST + "/batch"
+# Texts queued within PERSPECTIVE_BATCH_WAIT seconds of each other are sent out together, up to PERSPECTIVE_BATCH_SIZE at a time
+PERSPECTIVE_BATCH_WAIT = 0.05
+PERSPECTIVE_BATCH_SIZE = 25
+# Perspective requests are spaced out to average at most PERSPECTIVE_QPS per second (each text in a batch counts as one),
+# allowing bursts of up to PERSPECTIVE_BURST, so that busy periods stay under the quota instead of getting rate limited
+PERSPECTIVE_QPS = 10
+PERSPECTIVE_BURST = PERSPECTIVE_BATCH_SIZE
+
+# Texts shorter than this many bytes (like "ok" or "lol") are never sent to Perspective
+# They practically never score high enough to be flagged, so reviewing them is just a wasted round-trip
+MIN_TEXT_BYTES = 4
+# Perspective rejects texts over 3000 bytes, so longer texts are cut down to this many bytes before being sent
+MAX_TEXT_BYTES = 2800
+
+# The maximum number of texts whose Perspective scores are kept around for when the same text is sent again
+TEXT_CACHE_SIZE = 50000
+# Scores are also saved to this SQLite database so they're still cached after a restart
+# Saved scores older than TEXT_STORE_MAX_AGE seconds (30 days) are thrown out in case Perspective's models have changed since
+TEXT_STORE_PATH = "scores.db"
+TEXT_STORE_MAX_AGE = 30 * 24 * 60 * 60
+
+# Requests that get rate limited (HTTP 429) are retried up to RATE_LIMIT_RETRIES times, waiting for however long the
+# response's Retry-After header says, or else RATE_LIMIT_BACKOFF seconds (doubling after each attempt)
+RATE_LIMIT_RETRIES = 3
+RATE_LIMIT_BACKOFF = 1
+
+# Connection pool limits for the reviewer's HTTP session; idle connections are kept alive for HTTP_KEEPALIVE seconds
+# so that back-to-back requests to Perspective and Azure reuse an open TLS connection instead of making a new one
+HTTP_MAX_CONNECTIONS = 50
+HTTP_MAX_CONNECTIONS_PER_HOST = 20
+HTTP_KEEPALIVE = 60
+# Perspective's and Azure's hostnames are only looked up again after this many seconds when a new connection is opened
+HTTP_DNS_CACHE_TTL = 300
+# Requests that take longer than this many seconds (or this long just to connect) are abandoned instead of
+# holding up the review of a message forever
+HTTP_TIMEOUT = 15
+HTTP_CONNECT_TIMEOUT = 5
+
+# Path (appended to the Azure endpoint) of the Computer Vision image analysis API
+AZURE_ANALYZE_PATH = "/vision/v3.2/analyze"
+
 IMG_SIZE = 128
 HASH_SIZE = 12
+# Each hash is HASH_SIZE * HASH_SIZE bits, kept packed into this many bytes
+HASH_BYTES = HASH_SIZE * HASH_SIZE // 8
+# Images whose hashes differ by at most this many bits are treated as the same image
+HASH_MATCH_DISTANCE = 6
 CSAM_SCORE_THRESHOLD = 0.8
+# The scores given to attachments that aren't images
+NON_IMAGE_SCORES = {"GORE": 0, "ADULT": 0, "RACY": 0, "CSAM": 0, "CSAM_HASH": False}
 MODEL_GRAYSCALE = False
+MODEL_CHANNELS = 1 if MODEL_GRAYSCALE else 3
+CSAM_MODEL_PATH = "model.h5"
+# A quantized copy of the CSAM model made by classifier-code/quantize.py
+# It's loaded instead of CSAM_MODEL_PATH when it exists since it's smaller and faster to run on a CPU
+CSAM_TFLITE_PATH = "model.tflite"
 
 # Squelch TensorFlow debug messages
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
-class ContentReviewer():
-    def __init__(self):
-        if not os.path.isfile(TOKEN_PATH):
-            raise FileNotFoundError(f"{TOKEN_PATH} not found!")
-        with open(TOKEN_PATH) as file:
-            tokens = json.load(file)
-            self.discord_token = tokens["discord"]
-            self.perspective_key = tokens["perspective"]
-            self.azure_key = tokens["azure"]
-            self.azure_endpoint = tokens["azure_endpoint"]
-        self.computervision_client = ComputerVisionClient(self.azure_endpoint, CognitiveServicesCredentials(self.azure_key))
-        # Load model
-        self.csam_model = load_model('model.h5')
-        self.csam_model.compile(
-            loss="binary_crossentropy",
-            optimizer="adam",
-            metrics=["accuracy"]
+logger = logging.getLogger("discord.content_reviewer")
+
+# Raised when Perspective responds without any scores (e.g., for a language it doesn't support)
+class PerspectiveError(Exception):
+    pass
+
+# Serializes an object into a JSON request body (as bytes)
+def json_dumps(obj):
+    return orjson.dumps(obj) if orjson is not None else json.dumps(obj).encode("utf-8")
+
+# Parses a JSON response body straight from its raw bytes
+json_loads = orjson.loads if orjson is not None else json.loads
+
+# PERSPECTIVE_TEMPLATE encoded once, minus its opening brace, so each request only has to encode its own text
+PERSPECTIVE_BODY_SUFFIX = json_dumps(PERSPECTIVE_TEMPLATE)[1:]
+
+# Shrinks a cv2 image down to the IMG_SIZE x IMG_SIZE that the model and hashes work with
+# Images that are already that size are returned as they are, so an image can be resized once and shared
+def resize_image(img):
+    if img.shape[:2] == (IMG_SIZE, IMG_SIZE):
+        return img
+    return cv2.resize(img, (IMG_SIZE, IMG_SIZE))
+
+# Decodes an image's raw bytes with cv2 and resizes it with resize_image
+def decode_image(image_bytes):
+    return resize_image(cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR))
+
+# Returns an image's difference hash (dhash) as HASH_BYTES packed bytes
+# Each bit says whether a pixel is brighter than the one to its left once the image is shrunk to HASH_SIZE + 1 by HASH_SIZE
+# PIL still does the grayscale conversion and Lanczos resize (like imagehash.dhash did) so hashes match the ones already in hashlists
+def difference_hash(img):
+    pixels = np.asarray(Image.fromarray(img).convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS))
+    return np.packbits(pixels[:, 1:] > pixels[:, :-1]).tobytes()
+
+# Reads the API tokens out of the tokens file
+def load_tokens(path=TOKEN_PATH):
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f"{path} not found!")
+    with open(path, "rb") as file:
+        return json_loads(file.read())
+
+# Pulls each attribute's summary score out of a Perspective response
+def perspective_scores(response_dict):
+    if "attributeScores" not in response_dict:
+        raise PerspectiveError(response_dict.get("error", response_dict))
+    return {attr: score["summaryScore"]["value"] for attr, score in response_dict["attributeScores"].items()}
+
+# A token bucket that spaces out requests to average at most `rate` per second, with bursts of up to `burst`
+# Each caller reserves its tokens up front (letting the bucket go negative) and sleeps until they've refilled,
+# so callers are let through in the order they arrived without needing a lock
+class RateLimiter():
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+
+    # Waits until `tokens` requests can be made
+    async def acquire(self, tokens=1):
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= tokens
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+# Coalesces Perspective requests made around the same time into a single HTTP batch request
+# Texts are queued with `score`, and a background task sends whatever has been queued once PERSPECTIVE_BATCH_WAIT
+# seconds have passed since the first one (or PERSPECTIVE_BATCH_SIZE texts have piled up, whichever comes first)
+class PerspectiveBatcher():
+    def __init__(self, reviewer, max_wait=PERSPECTIVE_BATCH_WAIT, max_batch=PERSPECTIVE_BATCH_SIZE):
+        self.reviewer = reviewer
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        # The queue and its consumer are created the first time they're needed so they attach to the running event loop
+        self.queue = None
+        self._consumer = None
+        # Batches that are being sent; the event loop only keeps weak references to tasks, so they're kept here until they're done
+        self._sending = set()
+
+    # Queues some text for review and waits for its scores
+    async def score(self, text):
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+        if self._consumer is None or self._consumer.done():
+            self._consumer = asyncio.ensure_future(self._consume())
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((text, future))
+        return await future
+
+    # Pulls batches off of the queue forever, sending each one out without waiting for the last to finish
+    async def _consume(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            task = asyncio.ensure_future(self._send(batch))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    # Stops taking new texts, waits for the batches already being sent, and cancels anyone still waiting in the queue
+    async def close(self):
+        if self._consumer is not None:
+            self._consumer.cancel()
+        if self._sending:
+            await asyncio.gather(*self._sending, return_exceptions=True)
+        while self.queue is not None and not self.queue.empty():
+            _, future = self.queue.get_nowait()
+            future.cancel()
+
+    # Reviews a batch of texts and hands each one's scores (or error) back to whoever asked for them
+    async def _send(self, batch):
+        texts = [text for text, _ in batch]
+        if len(texts) == 1:
+            results = [await self._analyze_each(texts[0])]
+        else:
+            try:
+                results = await self.analyze_batch(texts)
+            except aiohttp.ClientResponseError as e:
+                if e.status >= 500:
+                    # The batch endpoint is having trouble, so fall back to sending the texts one at a time
+                    results = await asyncio.gather(*(self._analyze_each(text) for text in texts))
+                else:
+                    results = [e] * len(texts)
+            except Exception as e:
+                results = [e] * len(texts)
+        for (_, future), result in zip(batch, results):
+            # The caller may have been cancelled while it was waiting
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    # Same as ContentReviewer.analyze_text, except errors are returned instead of raised
+    async def _analyze_each(self, text):
+        try:
+            return await self.reviewer.analyze_text(text)
+        except Exception as e:
+            return e
+
+    # Sends several texts to Perspective as one multipart/mixed batch request
+    # Returns a list with the scores for each text, or the exception for any text whose part of the batch failed
+    async def analyze_batch(self, texts):
+        boundary = "batch_" + uuid.uuid4().hex
+        parts = []
+        for i, text in enumerate(texts):
+            parts.append((
+                f"--{boundary}\r\n"
+                "Content-Type: application/http\r\n"
+                f"Content-ID: <item{i}>\r\n\r\n"
+                f"POST {PERSPECTIVE_ANALYZE_PATH}?key={self.reviewer.perspective_key} HTTP/1.1\r\n"
+                "Content-Type: application/json\r\n\r\n"
+            ).encode("utf-8"))
+            parts.append(self.reviewer.perspective_request(text) + b"\r\n")
+        body = b"".join(parts) + f"--{boundary}--\r\n".encode("utf-8")
+
+        results = [None] * len(texts)
+        async def read_parts(response):
+            reader = aiohttp.MultipartReader.from_response(response)
+            async for part in reader:
+                # Each part's Content-ID is "<response-item{i}>", matching up with the "<item{i}>" it was sent with
+                # A part that can't be matched up is skipped, leaving its text to be retried on its own below
+                content_id = part.headers.get("Content-ID", "")
+                try:
+                    index = int(content_id.strip("<>").rsplit("item", 1)[-1])
+                except ValueError:
+                    continue
+                if not 0 <= index < len(texts):
+                    continue
+                # The part itself is a whole HTTP response: a status line and headers, a blank line, and then the JSON body
+                # Parts that can't be parsed are treated like missing ones and left as None
+                head, _, payload = (await part.read()).partition(b"\r\n\r\n")
+                try:
+                    status = int(head.split(None, 2)[1])
+                except (IndexError, ValueError):
+                    continue
+                if status == 429 or status >= 500:
+                    # Left as None so it gets retried on its own below
+                    continue
+                elif status >= 400:
+                    results[index] = aiohttp.ClientResponseError(response.request_info, (), status=status, message=payload.decode("utf-8", "replace"))
+                else:
+                    try:
+                        results[index] = perspective_scores(json_loads(payload))
+                    except PerspectiveError as e:
+                        results[index] = e
+                    except ValueError:
+                        # Not JSON (both json's and orjson's decode errors are ValueErrors)
+                        continue
+
+        # Every text in the batch counts against Perspective's quota on its own
+        await self.reviewer.perspective_limiter.acquire(len(texts))
+        await self.reviewer.post(
+            PERSPECTIVE_BATCH_URL,
+            read_parts,
+            headers={"Content-Type": f"multipart/mixed; boundary={boundary}"},
+            data=body
         )
-        self.hashlists = {
-            "csam": open("csam.hashlist", "a+")
-        }
-        self.hashlists["csam"].seek(0)
-        self.hashes = {
-            "csam": list(int(line, 16) for line in self.hashlists["csam"])
-        }
 
-    def review_text(self, message):
-        PERSPECTIVE_URL = 'https://commentanalyzer.googleapis.com/v1alpha1/comments:analyze'
+        # Anything that didn't come back (or was rate limited) in the batch response gets retried on its own
+        missing = [i for i, result in enumerate(results) if result is None]
+        for i, result in zip(missing, await asyncio.gather(*(self._analyze_each(texts[i]) for i in missing))):
+            results[i] = result
+        return results
+
+WHITESPACE_RE = re.compile(r"\s+")
+REPEATED_PUNCTUATION_RE = re.compile(r"([^\w\s])\1+")
+
+# Links and custom emojis, which Perspective has nothing to say about
+UNREVIEWABLE_RE = re.compile(r"https?://\S+|<a?:\w+:\d+>")
+# Any letter (in any language); text without one is only numbers, punctuation, and emojis
+LETTER_RE = re.compile(r"[^\W\d_]")
+
+# Returns whether some text is worth sending to Perspective at all
+# Short texts and texts without any letters outside of links and custom emojis (like "12:30", "!!!", or a row of emojis)
+# are never flagged, so they're let through without spending a request on them
+def worth_reviewing(text):
+    text = text.strip()
+    return len(text.encode("utf-8")) >= MIN_TEXT_BYTES and LETTER_RE.search(UNREVIEWABLE_RE.sub("", text)) is not None
+
+# Cuts text down to at most `max_bytes` bytes of UTF-8, preferring to end at the end of a sentence
+def truncate_text(text, max_bytes=MAX_TEXT_BYTES):
+    encoded = text.encode("utf-8")
+    if len(encoded) <= max_bytes:
+        return text
+    # Decoding with "ignore" drops a character that got cut in half
+    text = encoded[:max_bytes].decode("utf-8", "ignore")
+    end = max(text.rfind(". "), text.rfind("! "), text.rfind("? "), text.rfind("\n"))
+    # Only cut at a sentence boundary if it doesn't throw away more than half the text
+    if end > len(text) // 2:
+        text = text[:end + 1]
+    return text
+
+# Normalizes text into a key for the text cache so that trivially different copies of a message
+# (different capitalization, extra spaces, "hi!!!" vs "hi!") share the same scores
+# The key is a 16-byte hash of the normalized text so the cache doesn't hold onto copies of long messages
+def text_cache_key(text):
+    text = WHITESPACE_RE.sub(" ", text.strip().casefold())
+    text = REPEATED_PUNCTUATION_RE.sub(r"\1", text)
+    return blake2b(text.encode("utf-8"), digest_size=16).digest()
 
-        url = PERSPECTIVE_URL + '?key=' + self.perspective_key
-        data_dict = {
-            'comment': {
-                'text': message.content
-            },
-            'languages': ['en'],
-            'requestedAttributes': {
-                'SEVERE_TOXICITY': {},
-                'IDENTITY_ATTACK': {},
-                'INSULT': {},
-                'THREAT': {},
-                'TOXICITY': {},
-                'SPAM': {},
-                'SEXUALLY_EXPLICIT': {},
-                'FLIRTATION': {}
-            },
-            'doNotStore': True
+class ContentReviewer():
+    def __init__(self, executor=None, tokens=None):
+        # The executor that blocking work (model predictions and hashing) gets run in
+        # None uses the event loop's default executor
+        self.executor = executor
+        # The tokens can be passed in if they've already been loaded; otherwise they're read from TOKEN_PATH
+        if tokens is None:
+            tokens = load_tokens()
+        self.perspective_key = tokens["perspective"]
+        self.azure_key = tokens["azure"]
+        self.azure_endpoint = tokens["azure_endpoint"]
+        # The aiohttp session for Perspective and Azure requests gets created the first time it's needed (see http_session)
+        self._http = None
+        # Collects texts for Perspective so they can be sent out in batches
+        self.perspective = PerspectiveBatcher(self)
+        # Keeps requests to Perspective under its quota
+        self.perspective_limiter = RateLimiter(PERSPECTIVE_QPS, PERSPECTIVE_BURST)
+        # Scores for texts that have already been reviewed, keyed by text_cache_key
+        self.text_cache = LFUCache(TEXT_CACHE_SIZE)
+        # The same scores saved to disk (as JSON), for texts that aren't in text_cache because the bot was restarted
+        self.text_store = SQLiteCache(TEXT_STORE_PATH, max_age=TEXT_STORE_MAX_AGE)
+        # Load model
+        if os.path.isfile(CSAM_TFLITE_PATH):
+            self.csam_interpreter = tf.lite.Interpreter(model_path=CSAM_TFLITE_PATH)
+            self.csam_interpreter.allocate_tensors()
+            self.csam_input = self.csam_interpreter.get_input_details()[0]["index"]
+            self.csam_output = self.csam_interpreter.get_output_details()[0]["index"]
+            # The interpreter's input is resized to fit each batch, and it can only run one batch at a time
+            self.csam_batch_size = 1
+            self.csam_lock = threading.Lock()
+            self.csam_infer = self.tflite_infer
+        else:
+            # It's only used for inference, so there's no need to compile it with a loss and optimizer
+            self.csam_model = load_model(CSAM_MODEL_PATH, compile=False)
+            # Calls the model directly in a traced graph; model.predict has a lot of per-call overhead that isn't worth it for a few images
+            # The batch size is left open so the same graph is reused no matter how many images are scored at once
+            self.csam_infer = tf.function(
+                lambda images: self.csam_model(images, training=False),
+                input_signature=[tf.TensorSpec((None, IMG_SIZE, IMG_SIZE, MODEL_CHANNELS), tf.float32)]
+            )
+        # Run the model once on a blank image so it's traced (or the interpreter's kernels are prepared) now instead of while
+        # the first image someone sends is being reviewed
+        self.csam_infer(np.zeros((1, IMG_SIZE, IMG_SIZE, MODEL_CHANNELS), dtype=np.float32))
+        # Hashes of known images, each searchable for near matches (see HashList)
+        self.hashlists = {
+            "csam": HashList("csam.hashlist", HASH_BYTES, HASH_MATCH_DISTANCE)
         }
-        response = requests.post(url, data=json.dumps(data_dict))
-        response_dict = response.json()
-
-        scores = {}
-        for attr in response_dict["attributeScores"]:
-            scores[attr] = response_dict["attributeScores"][attr]["summaryScore"]["value"]
 
+    # Gets Perspective's scores for a message's text
+    # Texts that aren't worth reviewing get all zeros without going to Perspective
+    # Texts that have been seen before are answered from the cache (or the scores saved on disk), and the rest are queued up and sent to Perspective in batches (see PerspectiveBatcher)
+    # If Perspective can't score the text, it's logged and treated as all zeros (without being cached) so the message is let through
+    async def review_text(self, message):
+        if not worth_reviewing(message.content):
+            return dict.fromkeys(PERSPECTIVE_ATTRS, 0.0)
+        text = truncate_text(message.content.strip())
+        key = text_cache_key(text)
+        scores = self.text_cache.get(key)
+        if scores is None:
+            # The score store is on disk, so it's read and written in the executor to keep the event loop free
+            stored = await self.run_blocking(self.text_store.get, key)
+            if stored is not None:
+                scores = json_loads(stored)
+            else:
+                try:
+                    scores = await self.perspective.score(text)
+                except (aiohttp.ClientError, asyncio.TimeoutError, PerspectiveError, ValueError) as e:
+                    logger.warning(f"Perspective couldn't review message {message.id}: {e!r}")
+                    return dict.fromkeys(PERSPECTIVE_ATTRS, 0.0)
+                await self.run_blocking(self.text_store.put, key, json_dumps(scores))
+            self.text_cache.put(key, scores)
         return scores
 
-    async def review_images(self, message, as_array=False):
-        scores_list = []
-        for attachment in message.attachments:
-            if not attachment.height:
-                # Non-image attachments will have no height and should be skipped
-                scores_list.append({"GORE": 0, "ADULT": 0, "RACY": 0, "CSAM": 0})
-                continue
-
-            scores = {}
-
-            # Download the image to a stream
-            file_stream = BytesIO()
-            await attachment.save(file_stream, use_cached=True)
-
-            # Turn it into a numpy array via cv2
-            file_stream.seek(0)
-            arr_img = cv2.imdecode(np.asarray(bytearray(file_stream.read()), dtype=np.uint8), cv2.IMREAD_COLOR)
+    # Builds the JSON body of a Perspective analyze request for some text (as bytes)
+    # Only the comment changes between requests, so it's spliced in front of the pre-encoded PERSPECTIVE_BODY_SUFFIX
+    def perspective_request(self, text):
+        return b'{"comment":{"text":' + json_dumps(text) + b'},' + PERSPECTIVE_BODY_SUFFIX
+
+    # Sends a single text to Perspective on its own and returns its scores
+    # The request goes through the shared aiohttp session so the event loop is free to handle other messages while waiting
+    async def analyze_text(self, text):
+        async def read_scores(response):
+            return perspective_scores(json_loads(await response.read()))
+
+        await self.perspective_limiter.acquire()
+        return await self.post(
+            PERSPECTIVE_URL,
+            read_scores,
+            params={"key": self.perspective_key},
+            headers={"Content-Type": "application/json"},
+            data=self.perspective_request(text)
+        )
 
-            # Get a CSAM score for the image
-            scores["CSAM"] = self.csam_score(arr_img)
+    # Makes a POST request with the shared HTTP session and returns `await read(response)` once it succeeds
+    # Rate limited requests are retried (see RATE_LIMIT_RETRIES) and any other error raises an aiohttp.ClientResponseError
+    async def post(self, url, read, retries=RATE_LIMIT_RETRIES, **kwargs):
+        backoff = RATE_LIMIT_BACKOFF
+        for attempt in range(retries + 1):
+            async with self.http_session().post(url, **kwargs) as response:
+                if response.status != 429 or attempt == retries:
+                    response.raise_for_status()
+                    return await read(response)
+                retry_after = response.headers.get("Retry-After", "")
+                wait = int(retry_after) if retry_after.isdigit() else backoff
+            logger.warning(f"Rate limited by {response.url.host}; retrying in {wait}s")
+            await asyncio.sleep(wait)
+            backoff *= 2
+
+    # Returns the aiohttp session used for HTTP requests, creating a new one if there isn't one open
+    # This has to be called from within a coroutine since the session attaches itself to the running event loop
+    def http_session(self):
+        if self._http is None or self._http.closed:
+            self._http = aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+                limit=HTTP_MAX_CONNECTIONS,
+                limit_per_host=HTTP_MAX_CONNECTIONS_PER_HOST,
+                keepalive_timeout=HTTP_KEEPALIVE,
+                ttl_dns_cache=HTTP_DNS_CACHE_TTL
+            ), timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT))
+        return self._http
+
+    # Closes the aiohttp session (a new one is made if another request is made afterward)
+    # Any scores that haven't been saved to disk yet are saved too
+    async def close(self):
+        # Batches still being sent need the HTTP session, so they're finished first
+        await self.perspective.close()
+        if self._http is not None and not self._http.closed:
+            await self._http.close()
+        # The final flush runs in the loop's default executor since self.executor may already be shut down by now
+        await asyncio.get_running_loop().run_in_executor(None, self.flush)
+
+    # Writes out everything that's still waiting to be saved to the score store and the hashlist files
+    def flush(self):
+        self.text_store.flush()
+        for hashlist in self.hashlists.values():
+            hashlist.flush()
+
+    # Runs a blocking function in self.executor so that it doesn't block the event loop
+    async def run_blocking(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
 
+    async def review_images(self, message, as_array=False):
+        # Non-image attachments will have no height and should be skipped
+        images = [attachment for attachment in message.attachments if attachment.height]
+        if not images:
+            return [dict(NON_IMAGE_SCORES) for _ in message.attachments]
+
+        # Download every image at once
+        downloads = await asyncio.gather(*(self.download_image(attachment) for attachment in images))
+
+        # Get a CSAM score for every image in one pass through the model
+        csam_scores = await self.run_blocking(self.csam_scores, [arr_img for _, arr_img in downloads])
+
+        # Check the hashes and ask Azure about every image at once
+        reviewed = iter(await asyncio.gather(*(
+            self.review_image(image_bytes, arr_img, csam_score)
+            for (image_bytes, arr_img), csam_score in zip(downloads, csam_scores)
+        )))
+        return [next(reviewed) if attachment.height else dict(NON_IMAGE_SCORES) for attachment in message.attachments]
+
+    # Downloads an image attachment and returns its raw bytes along with it decoded as a numpy array via cv2
+    # The array is already resized (see decode_image), so the model and the hash comparison don't each resize it again
+    async def download_image(self, attachment):
+        file_stream = BytesIO()
+        await attachment.save(file_stream, use_cached=True)
+        image_bytes = file_stream.getvalue()
+        arr_img = await self.run_blocking(decode_image, image_bytes)
+        return image_bytes, arr_img
+
+    # Finishes the scores for a single image that already has its CSAM score
+    # The hash comparison (in the executor) and the Azure request run at the same time
+    async def review_image(self, image_bytes, arr_img, csam_score):
+        csam_hash, adult = await asyncio.gather(
             # Check if this image is in our list of blacklisted hashes
-            scores["CSAM_HASH"] = self.hash_compare(arr_img)
-
+            self.run_blocking(self.hash_compare, arr_img),
             # Use Azure to detect other components (including gory, sexually explicit, and racy images)
-            # First seek the image stream back to 0 to be read again
-            file_stream.seek(0)
-            # Get all the scores mentioned above
-            results = self.computervision_client.analyze_image_in_stream(file_stream, ["adult"])
+            self.analyze_image(image_bytes)
+        )
+        return {
+            "CSAM": csam_score,
+            "CSAM_HASH": csam_hash,
             # Looks for blood and gore to mark as promoting violence or terrorism
-            scores["GORE"] = results.adult.gore_score
+            "GORE": adult["goreScore"],
             # Looks for sexually explicit photos to mark as sexual content
-            scores["ADULT"] = results.adult.adult_score
+            "ADULT": adult["adultScore"],
             # Looks for suggestive photos to mark as sexual content with a lower priority
-            scores["RACY"] = results.adult.racy_score
+            "RACY": adult["racyScore"]
+        }
 
-            # Add this set of scores to the list to move on to the next attachment
-            scores_list.append(scores)
-        return scores_list
+    # Sends an image's raw bytes to Azure's Computer Vision API and returns its "adult" analysis
+    # (a dict including "adultScore", "racyScore", and "goreScore")
+    # Raises an aiohttp.ClientResponseError if the request fails (e.g., from still hitting the rate limit after `retries` retries)
+    async def analyze_image(self, image_bytes, retries=RATE_LIMIT_RETRIES):
+        async def read_adult(response):
+            return json_loads(await response.read())["adult"]
+
+        return await self.post(
+            self.azure_endpoint.rstrip("/") + AZURE_ANALYZE_PATH,
+            read_adult,
+            retries=retries,
+            params={"visualFeatures": "Adult"},
+            headers={
+                "Ocp-Apim-Subscription-Key": self.azure_key,
+                "Content-Type": "application/octet-stream"
+            },
+            data=image_bytes
+        )
+
+    # Returns the CSAM model's scores for a list of (BGR) numpy arrays from cv2
+    # The images are stacked into one batch so the model only runs once however many there are
+    def csam_scores(self, imgs):
+        batch = np.empty((len(imgs), IMG_SIZE, IMG_SIZE, MODEL_CHANNELS), dtype=np.float32)
+        for i, img in enumerate(imgs):
+            img = resize_image(img)
+            if MODEL_GRAYSCALE:
+                img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            batch[i] = np.reshape(img, (IMG_SIZE, IMG_SIZE, MODEL_CHANNELS))
+
+        # The model outputs two scores per image; the first is the CSAM score
+        return np.asarray(self.csam_infer(batch))[:, 0].tolist()
+
+    # Runs a batch of images through the quantized model (see CSAM_TFLITE_PATH)
+    def tflite_infer(self, batch):
+        with self.csam_lock:
+            if len(batch) != self.csam_batch_size:
+                self.csam_interpreter.resize_tensor_input(self.csam_input, batch.shape)
+                self.csam_interpreter.allocate_tensors()
+                self.csam_batch_size = len(batch)
+            self.csam_interpreter.set_tensor(self.csam_input, batch)
+            self.csam_interpreter.invoke()
+            return self.csam_interpreter.get_tensor(self.csam_output)
 
     def csam_score(self, img):
-        # `img` should be a numpy array from cv2
-        img = cv2.cvtColor(cv2.resize(img, (IMG_SIZE, IMG_SIZE)), cv2.COLOR_BGR2GRAY)
-        img = np.reshape(img, (1, IMG_SIZE, IMG_SIZE, 1 if MODEL_GRAYSCALE else 3))
+        # `img` should be a (BGR) numpy array from cv2
+        return self.csam_scores([img])[0]
 
-        return self.csam_model.predict(img)[0][0]
+    # Returns an image's dhash as packed bytes
+    def image_hash(self, img):
+        # `img` should a be a numpy array from cv2
+        return difference_hash(resize_image(img))
 
     def hash_compare(self, img):
-        # `img` should a be a numpy array from cv2
-        img = cv2.resize(img, (IMG_SIZE, IMG_SIZE))
-        # Convert it to a PIL Image
-        pil = Image.fromarray(img)
         # Calculate this image's hash
-        dhash = int(str(difference_hash(pil, hash_size=HASH_SIZE)), 16)
-
-        # Iterate through hashes for any hash that is a difference of less than 6
-        for _hash in self.hashes["csam"]:
-            hash_difference = bin(_hash ^ dhash).count("1")
-            if hash_difference <= 6:
-                # If this is a slightly different image, add its hash to the hashlist so we can detect against it too
-                if hash_difference > 0:
-                    self.save_hash(img)
-                return True
+        dhash = self.image_hash(img)
+
+        # Look for any hash that differs by at most HASH_MATCH_DISTANCE bits
+        distance = self.hashlists["csam"].nearest(dhash)
         # Return False if we never found a matching hash
-        return False
+        if distance is None:
+            return False
+        # If this is a slightly different image, add its hash to the hashlist so we can detect against it too
+        if distance > 0:
+            self.hashlists["csam"].add(dhash)
+        return True
 
     def save_hash(self, img):
-        # `img` should a be a numpy array from cv2
-        img = cv2.resize(img, (IMG_SIZE, IMG_SIZE))
-        pil = Image.fromarray(img)
-
         # Calculate this image's hash
-        dhash = difference_hash(pil, hash_size=HASH_SIZE)
+        dhash = self.image_hash(img)
 
-        # Add this has to our existing in-memory list
-        self.hashes["csam"].append(int(str(dhash), 16))
-        # Write this has to the csam.hashlist file for the future
-        self.hashlists["csam"].write(str(dhash) + "\n")
-        # Write immediately since we usually don't end up properly close()-ing our file...
-        self.hashlists["csam"].flush()
+        # Add this hash to the hashlist (and the csam.hashlist file) for the future
+        self.hashlists["csam"].add(dhash)
 
 if __name__ == "__main__":
-    from azure.cognitiveservices.vision.computervision.models._models_py3 import ComputerVisionErrorException as CVError
-
     reviewer = ContentReviewer()
+    loop = asyncio.get_event_loop()
 
     offset = sys.argv[1] if len(sys.argv) > 1 else "0"
     try:
@@ -181,20 +641,18 @@ if __name__ == "__main__":
 
     skipCV = False
     for file in files:
-        img = cv2.imread(f"dataset/{file}", 0 if MODEL_GRAYSCALE else 1)
-        img = cv2.resize(img, (IMG_SIZE, IMG_SIZE))
-        img = np.reshape(img, (1, IMG_SIZE, IMG_SIZE, 1 if MODEL_GRAYSCALE else 3))
-
-        csam_prediction = reviewer.csam_model.predict(img)[0][0]
+        csam_prediction = reviewer.csam_score(cv2.imread(f"dataset/{file}", cv2.IMREAD_COLOR))
 
         try:
             if not skipCV:
                 with open(f"dataset/{file}", "rb") as f:
-                    azure_results = reviewer.computervision_client.analyze_image_in_stream(f, ["adult"])
-        except CVError:
+                    azure_results = loop.run_until_complete(reviewer.analyze_image(f.read(), retries=0))
+        except aiohttp.ClientResponseError:
             skipCV = True
 
         if skipCV:
             print(f"{file}:\n  {'CSAM':^6}  {'GORE':^6}  {'ADULT':^6}  {'RACY':^6}\n  \u001b[{32 if csam_prediction > CSAM_SCORE_THRESHOLD else 2}m{csam_prediction * 100:6.2f}\u001b[0m  \u001b[33m{'WAIT':^6}\u001b[0m  \u001b[33m{'WAIT':^6}\u001b[0m  \u001b[33m{'WAIT':^6}\u001b[0m")
         else:
-            print(f"{file}:\n  {'CSAM':^6}  {'GORE':^6}  {'ADULT':^6}  {'RACY':^6}\n  \u001b[{32 if csam_prediction > CSAM_SCORE_THRESHOLD else 2}m{csam_prediction * 100:6.2f}\u001b[0m  \u001b[{32 if azure_results.adult.gore_score > 0.75 else 2}m{azure_results.adult.gore_score * 100:6.2f}\u001b[0m  \u001b[{32 if azure_results.adult.adult_score > 0.85 else 2}m{azure_results.adult.adult_score * 100:6.2f}\u001b[0m  \u001b[{32 if azure_results.adult.racy_score > 0.8 else 2}m{azure_results.adult.racy_score * 100:6.2f}\u001b[0m")
\ No newline at end of file
+            print(f"{file}:\n  {'CSAM':^6}  {'GORE':^6}  {'ADULT':^6}  {'RACY':^6}\n  \u001b[{32 if csam_prediction > CSAM_SCORE_THRESHOLD else 2}m{csam_prediction * 100:6.2f}\u001b[0m  \u001b[{32 if azure_results['goreScore'] > 0.75 else 2}m{azure_results['goreScore'] * 100:6.2f}\u001b[0m  \u001b[{32 if azure_results['adultScore'] > 0.85 else 2}m{azure_results['adultScore'] * 100:6.2f}\u001b[0m  \u001b[{32 if azure_results['racyScore'] > 0.8 else 2}m{azure_results['racyScore'] * 100:6.2f}\u001b[0m")
+
+    loop.run_until_complete(reviewer.close())
\ No newline at end of file
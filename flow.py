@@ -12,11 +12,72 @@ from contextlib import suppress
 import report
 from consts import *
 
+# Parses the guild, channel, and message IDs out of a message link
+MESSAGE_LINK_RE = re.compile(r"/(\d+|@me)/(\d+)/(\d+)")
+# Matches the discriminator at the end of a username (like the "#1234" in "username#1234")
+DISCRIMINATOR_RE = re.compile(r"#(\d+)$")
+# Matches a displayed code block (```code```), capturing the code inside of it
+CODE_BLOCK_RE = re.compile(r"```(?:\S*\n)?([\s\S]*?)\n?```")
+# Matches an inline code element (`code`)
+INLINE_CODE_RE = re.compile(r"`[^`]*`")
+# Matches a "|" that's immediately followed by another "|"
+DOUBLE_BAR_RE = re.compile(r"\|(?=\|)")
+
+# The urgency of an automatically flagged message's report, based on its abuse type (anything else gets 0)
+FLAGGED_MESSAGE_URGENCY = {
+    AbuseType.SPAM: 0,
+    AbuseType.VIOLENCE: 2,
+    AbuseType.SEXUAL: 1,
+    AbuseType.HATEFUL: 1,
+    AbuseType.HARASS: 1
+}
+
+# How many seconds the 📋 under an SOS message keeps listening for clicks (an hour)
+SOS_REPORT_TIMEOUT = 60 * 60
+# How many seconds a report that's being created can go without a reply before it's canceled (half an hour)
+REPORT_CREATION_TIMEOUT = 30 * 60
 
 # Dedents a string and leaves non-strings alone
 def dedent(obj):
     return _dedent(obj) if isinstance(obj, str) else obj
 
+# Converts a displayed code block into a series of inline code elements (one per line, padded to the same width)
+def _code_block_to_inline(match):
+    code = match.group(1).split("\n")
+    longestLine = max(map(len, code))
+    return "\n".join(f"`{{:{longestLine}}}`".format(line) for line in code)
+
+# Inserts a zero-width space between every pair of "|" in an inline code element
+def _break_code_spoilers(match):
+    return DOUBLE_BAR_RE.sub("|\u200b", match.group(0))
+
+# Alters a message's content slightly to disallow clever markdown formatting from getting through a spoiler
+# Each substitution is a single pass over the content
+def sanitize_spoilers(content):
+    # Without any code elements, only the spoiler tags need escaping, so the two regex passes below are skipped
+    # (replace hands back the same string without copying it when there's no "||" either)
+    if "`" not in content:
+        return content.replace("||", "\\|\\|")
+    # Displayed code block elements are converted into inline code blocks since displayed code blocks are not hidden by spoilers
+    content = CODE_BLOCK_RE.sub(_code_block_to_inline, content)
+    # Now, any "||" in code blocks are converted to a look-alike (by inserting a zero-width space in between them)
+    # This is to prevent them from being recognized as closing spoiler elements
+    # Outside of code blocks, we can just escape the double bars with a "\|" but code blocks will show the literal "\"
+    content = INLINE_CODE_RE.sub(_break_code_spoilers, content)
+    # Remove any remaining spoiler tags in the comment by escaping each "|"
+    return content.replace("||", "\\|\\|")
+
+# A message the bot re-sent on a user's behalf: the user's `original` message, the bot's "<user> says:" `prefix`
+# message, and the `replacement` message with the original's content
+class ResentMessage():
+    # One is kept for every message the bot re-sends, so they're slotted to keep them small
+    __slots__ = ("original", "prefix", "replacement")
+
+    def __init__(self, original, prefix, replacement):
+        self.original = original
+        self.prefix = prefix
+        self.replacement = replacement
+
 # Creates a textual preview of a message's content
 # Usually, it's jsut the message's content but can also include images and files.
 def message_preview_text(message):
@@ -53,6 +114,7 @@ class Flow():
     def __init__(self, client, channel, start_state, quit_state=None):
         self.client = client
         self.channel = channel # The DM channel to send the messages in
+        self._registrations = [] # The (message, Reaction) pairs this flow has registered, so they can be forgotten by end()
         asyncio.create_task(self.transition_to_state(start_state)) # Perform a transition to the initial start state
         self._quit_state = quit_state
         self._prequit_state = None
@@ -94,6 +156,7 @@ class Flow():
         for msg in msgs:
             if isinstance(msg, Reaction):
                 asyncio.create_task(msg.register_message(lastMessage))
+                self._registrations.append((lastMessage, msg))
             elif isinstance(msg, discord.Embed):
                 lastMessage = await self.channel.send(embed=msg)
             elif isinstance(msg, discord.File):
@@ -127,6 +190,23 @@ class Flow():
         except (TypeError, discord.errors.Forbidden):
             pass
 
+    # Removes this flow from a user's list of flows once it's over
+    # The reactions it registered stop listening for clicks too, since their handlers would otherwise keep the
+    # finished flow (and the messages it references) alive for as long as the bot runs
+    # Ending a flow that has already ended does nothing
+    def end(self, user_id):
+        # .get so that looking up a user without any flows doesn't add an empty entry to the defaultdict
+        user_flows = self.client.flows.get(user_id)
+        if user_flows is not None:
+            with suppress(ValueError):
+                user_flows.remove(self)
+            # Users without any open flows are forgotten so that the map doesn't keep an entry for everyone who ever had one
+            if not user_flows:
+                del self.client.flows[user_id]
+        for message, reaction in self._registrations:
+            reaction.forget_message(message)
+        self._registrations.clear()
+
     # Simulates a reply by sending a message to forward_message with simulated=True
     async def simulate_reply(self, message):
         return await self.forward_message(message, simulated=True)
@@ -152,6 +232,28 @@ class Flow():
     def react_done(self):
         return Reaction("✅", toggle_handler=self.simulate_reply_handler("done"))
 
+    # Returns a Reaction that transitions the flow to `state` when it's toggled
+    # With `click_only`, it only does so when the reaction is added, not when it's removed again
+    def react_state(self, emoji, state, once_per_message=False, click_only=False):
+        return self._handler_reaction(emoji, self._transition_handler, state, once_per_message, click_only)
+
+    # Returns a Reaction that performs `action` (see perform_action) when it's toggled (or only clicked, with `click_only`)
+    def react_action(self, emoji, action, once_per_message=False, click_only=False):
+        return self._handler_reaction(emoji, self._action_handler, action, once_per_message, click_only)
+
+    # Builds the Reaction for react_state and react_action, registering `handler` as a click or toggle handler
+    def _handler_reaction(self, emoji, handler, data, once_per_message, click_only):
+        if click_only:
+            return Reaction(emoji, click_handler=handler, once_per_message=once_per_message, data=data)
+        return Reaction(emoji, toggle_handler=handler, once_per_message=once_per_message, data=data)
+
+    # Reaction handlers for react_state and react_action; the Reaction carries the state or action to use
+    def _transition_handler(self, reaction, discordClient, discordReaction, user):
+        asyncio.create_task(self.transition_to_state(reaction.data))
+
+    def _action_handler(self, reaction, discordClient, discordReaction, user):
+        asyncio.create_task(self.perform_action(reaction.data))
+
     # Returns a reaction that will simulate a specific number between 1 and 10
     def react_index(self, index):
         return Reaction(("0️⃣","1️⃣","2️⃣","3️⃣","4️⃣","5️⃣","6️⃣","7️⃣","8️⃣","9️⃣","🔟")[index], click_handler=self.simulate_reply_handler(str(index)))
@@ -186,7 +288,7 @@ class SentBadMessageFlow(Flow):
         "START"
     ))
     def __init__(self, client, message, always_report=False, explicit=False, abuse_type=None, explanation=None, urgency=None):
-        super().__init__(client=client, channel=message.author.dm_channel, start_state=SentBadMessageFlow.State.START)
+        super().__init__(client=client, channel=client.dm_channel(message.author), start_state=SentBadMessageFlow.State.START)
         # The original discord.Message that got flagged
         self.message = message
         # Whether the message is explicit enough to hide the message with spoilers
@@ -205,14 +307,7 @@ class SentBadMessageFlow(Flow):
         self.always_report = always_report
 
         # Assign an urgency to this message based on the abuse type (or if urgency was specified)
-        self.urgency = {
-            None: 0,
-            AbuseType.SPAM: 0,
-            AbuseType.VIOLENCE: 2,
-            AbuseType.SEXUAL: 1,
-            AbuseType.HATEFUL: 1,
-            AbuseType.HARASS: 1
-        }[self.abuse_type] if urgency is None else urgency
+        self.urgency = FLAGGED_MESSAGE_URGENCY.get(self.abuse_type, 0) if urgency is None else urgency
 
         # After five minutes of inactivity, cancel this flow and tell the user that their message can no longer be re-sent by the bot
         # This is to prevent someone from just not answering anything, because we still need to send a report no matter what
@@ -232,13 +327,14 @@ class SentBadMessageFlow(Flow):
                 self.react_no()
             )
         else:
-            if message.lower() in YES_KEYWORDS:
+            lowered = message.lower()
+            if lowered in YES_KEYWORDS:
                 # Resend the user's original message
                 await self.resend_message()
                 # Send an Automated Report for this message
                 await self.send_report(outcome=True)
                 # Delete the flow from the user's list of flows
-                self.client.flows[self.message.author.id].remove(self)
+                self.end(self.message.author.id)
                 # Prevent the timeout timer from activating later
                 self.timeout_task.cancel()
                 # Show the user that their message was sent
@@ -249,9 +345,9 @@ class SentBadMessageFlow(Flow):
                         description=f"[Go to your message]({self.replacement_message.jump_url})"
                     )
                 )
-            elif message.lower() in NO_KEYWORDS:
+            elif lowered in NO_KEYWORDS:
                 # Delete the flow from the user's list of flows
-                self.client.flows[self.message.author.id].remove(self)
+                self.end(self.message.author.id)
                 # Prevent the timeout timer from activating later
                 self.timeout_task.cancel()
                 # Send a report is alwways_report is True
@@ -277,26 +373,7 @@ class SentBadMessageFlow(Flow):
             content = self.message.content
 
             if self.client.smart_spoilers:
-                # This alters the message slightly to disallow clever markdown formatting from getting through the spoiler
-                # Displayed code block elements are converted into inline code blocks since displayed code blocks are not hidden by spoilers
-                reMatch = re.search(r"```(?:\S*\n)?([\s\S]*?)\n?```", content)
-                while reMatch:
-                    code = reMatch.group(1).split("\n")
-                    longestLine = max(map(lambda line: len(line), code))
-                    code = "\n".join(f"`{{:{longestLine}}}`".format(line) for line in code)
-                    content = content[:reMatch.start()] + code + content[reMatch.end():]
-                    reMatch = re.search(r"```(?:\S*\n)?([\s\S]*?)\n?```", content)
-
-                # Now, any "||" in code blocks are converted to a look-alike (by inserting a zero-width space in between them)
-                # This is to prevent them from being recognized as closing spoiler elements
-                # Outside of code blocks, we can just escape the double bars with a "\|" but code blocks will show the literal "\"
-                reMatch = re.search(r"(`(?:[^`]|\|(?!\|))*?\|)(\|(?:[^`]|\|(?!\|))*?`)", content)
-                while reMatch:
-                    content = content[:reMatch.start()] + reMatch.group(1) + "\u200b" + reMatch.group(2) + content[reMatch.end():]
-                    reMatch = re.search(r"(`(?:[^`]|\|(?!\|))*?\|)(\|(?:[^`]|\|(?!\|))*?`)", content)
-
-                # Remove any remaining spoiler tags in the comment by escaping each "|"
-                content = content.replace("||", "\\|\\|")
+                content = sanitize_spoilers(content)
 
             # Send a message to show who this message is from
             self.prefix_message = await origChannel.send(content=f"*The following message may contain inappropriate content. Click the black bar to reveal it.*\n*{self.message.author.mention} says:*")
@@ -309,17 +386,13 @@ class SentBadMessageFlow(Flow):
             # Show a non-explicit message as-is
             self.replacement_message = await origChannel.send(content=self.message.content, files=files)
 
-        # Update message_aliases so that we know which original message these two replacement messages actually represent
-        self.client.message_aliases[self.prefix_message.id] = self.message
-        self.client.message_aliases[self.replacement_message.id] = self.message
-        self.client.message_aliases[self.message.id] = self.replacement_message
-
-        # Update message_pairs so that we can reference each of the two sent messages from each other
-        self.client.message_pairs[self.replacement_message.id] = self.prefix_message
-        self.client.message_pairs[self.prefix_message.id] = self.replacement_message
+        # Record the three messages together so that any one of them can be used to look up the others
+        resent = ResentMessage(self.message, self.prefix_message, self.replacement_message)
+        for msg in (self.message, self.prefix_message, self.replacement_message):
+            self.client.resent_messages.put(msg.id, resent)
 
         # The replacement message gets an SOS reaction added to it
-        await self.replacement_message.add_reaction("🆘")
+        await self.replacement_message.add_reaction(SOS_EMOJI)
 
     # Sends an Automated Report to the mod channel
     async def send_report(self, outcome):
@@ -335,12 +408,12 @@ class SentBadMessageFlow(Flow):
             message_deleted=not outcome
         )
 
-        await asyncio.gather(*(self.report.send_to_channel(channel, assignable=True) for channel in self.client.mod_channels.values()))
+        await self.client.send_to_mod_channels(self.report)
 
     # A callback that gets called after five minutes if the user doesn't take any action
     def timeout_reponse(self):
         # Delete the flow from the user's list of flows
-        self.client.flows[self.message.author.id].remove(self)
+        self.end(self.message.author.id)
         # Tell the user that their inactivity caused them to not be able to take action anymore
         asyncio.create_task(self.say(("Your message can no longer be sent due to inactivity. You can send your original message manually if you'd like.")))
         # Send a report if always_report is enabled
@@ -369,7 +442,7 @@ class EditedBadMessageFlow(Flow):
     ))
 
     def __init__(self, client, message, explicit=False, reason=None, explanation=None, expiration_time=10 * 60):
-        super().__init__(client=client, channel=message.author.dm_channel, start_state=EditedBadMessageFlow.State.START)
+        super().__init__(client=client, channel=client.dm_channel(message.author), start_state=EditedBadMessageFlow.State.START)
         self.author = message.author
         self.message = message
         self.explicit = explicit
@@ -400,7 +473,7 @@ class EditedBadMessageFlow(Flow):
             if self.timer_message:
                 try:
                     await self.timer_message.edit(embed=self.timer_embed())
-                except discord.errorsNotFound:
+                except discord.errors.NotFound:
                     self.timer_message = None
             if self.time_elapsed >= self.expiration_time:
                 await self.transition_to_state(EditedBadMessageFlow.State.TIME_EXPIRED)
@@ -412,7 +485,7 @@ class EditedBadMessageFlow(Flow):
             await self.second_timer
         try:
             await self.message.delete()
-        except discord.errors.NotFound:
+        except (discord.errors.Forbidden, discord.errors.NotFound):
             pass
         await self.close()
         await self.say("Your edited message was deleted due to inaction.")
@@ -436,7 +509,7 @@ class EditedBadMessageFlow(Flow):
                     You can re-edit it now if you wish to do that, or say `re-send` to have the bot re-send the message with this new edit. You can also push the button below to re-send it.
                     If no action is taken within ten minutes, the bot will delete the message from the channel altogether.
                 """,
-                Reaction("🗨", click_handler=lambda *args: asyncio.create_task(self.transition_to_state(EditedBadMessageFlow.State.RESEND)))
+                self.react_state("🗨", EditedBadMessageFlow.State.RESEND, once_per_message=True, click_only=True)
             ))
             self.timer_message = await self.channel.send(embed=self.timer_embed())
         else:
@@ -452,21 +525,8 @@ class EditedBadMessageFlow(Flow):
 
     async def edited(self, new_message):
         self.message = new_message
-        scores = self.client.eval_text(self.message)
-
-        still_bad = False
-        if scores["SPAM"] > 0.8:
-            still_bad = True
-        elif scores["THREAT"] > 0.75:
-            still_bad = True
-        elif scores["IDENTITY_ATTACK"] > 0.75:
-            still_bad = True
-        elif scores["SEVERE_TOXICITY"] > 0.9:
-            still_bad = True
-        elif scores["TOXICITY"] > 0.9 or scores["INSULT"] > 0.9:
-            still_bad = True
-
-        if still_bad:
+
+        if await self.client.review_edit(self.message) is not None:
             await self.transition_to_state(EditedBadMessageFlow.State.UNACCEPTABLE_EDIT)
         else:
             await self.transition_to_state(EditedBadMessageFlow.State.ACCEPTABLE_EDIT)
@@ -483,8 +543,8 @@ class EditedBadMessageFlow(Flow):
         if self.timer_message is not None:
             await self.timer_message.delete()
         self.timer_message = None
-        self.client.flows[self.author.id].remove(self)
-        del self.client.messages_pending_edit[self.message.id]
+        self.end(self.author.id)
+        self.client.messages_pending_edit.pop(self.message.id)
 
 
 
@@ -495,18 +555,22 @@ class SOSFlow(Flow):
     ))
 
     def __init__(self, client, message, user):
-        super().__init__(client=client, channel=user.dm_channel, start_state=SOSFlow.State.START)
+        super().__init__(client=client, channel=client.dm_channel(user), start_state=SOSFlow.State.START)
         self.message = message
         self.replacement_message = None
-        if self.message.id in client.message_pairs:
-            self.message = client.message_aliases[self.message.id]
-            self.replacement_message = message
+        resent = client.resent_copy(self.message.id)
+        if resent is not None:
+            self.message = resent.original
+            self.replacement_message = resent.replacement
         self.user = user
 
     def start(self, message, simulated=False, introducing=False):
-        self.client.flows[self.user.id].remove(self)
+        # The flow ends right away so that the user's DMs don't go to it, but its 📋 keeps listening for clicks
+        # until this timer ends it again (ending it a second time only forgets the 📋)
+        self.end(self.user.id)
+        self.client.loop.call_later(SOS_REPORT_TIMEOUT, self.end, self.user.id)
         return (
-            "You clicked 🆘 on the following message:",
+            f"You clicked {SOS_EMOJI} on the following message:",
             discord.Embed(
                 color=discord.Color.greyple(),
                 description=message_preview_text(self.message)
@@ -520,7 +584,6 @@ class SOSFlow(Flow):
         )
 
     def start_report(self, reaction, discordClient, discordReaction, user):
-        self.client.flows[self.user.id] = self.client.flows.get(self.user.id, [])
         self.client.flows[self.user.id].append(UserReportCreationFlow(
             client=self.client,
             reporter=self.user,
@@ -545,16 +608,35 @@ class UserReportCreationFlow(Flow):
     ))
 
     def __init__(self, client, reporter, message=None):
-        super().__init__(client=client, channel=reporter.dm_channel, start_state=UserReportCreationFlow.State.REPORT_START, quit_state=UserReportCreationFlow.State.REPORT_QUIT)
+        super().__init__(client=client, channel=client.dm_channel(reporter), start_state=UserReportCreationFlow.State.REPORT_START, quit_state=UserReportCreationFlow.State.REPORT_QUIT)
         self.reporter = reporter
         self.abuse_type = None
         self.sent_report = None
         self.message = message
-        if self.message and self.message.id in self.client.message_pairs:
-            self.replacement_message = self.message
-            self.message = self.client.message_aliases[self.message.id]
+        resent = self.client.resent_copy(self.message.id) if self.message else None
+        if resent is not None:
+            self.replacement_message = resent.replacement
+            self.message = resent.original
         else:
             self.replacement_message = None
+        # Cancel the report if the user stops replying, so an abandoned report doesn't keep its buttons listening forever
+        self.timeout_task = client.loop.call_later(REPORT_CREATION_TIMEOUT, self.timeout_response)
+
+    # Every reply (including a click, which is simulated as one) restarts the inactivity timer
+    async def forward_message(self, message, simulated=False):
+        self.timeout_task.cancel()
+        self.timeout_task = self.client.loop.call_later(REPORT_CREATION_TIMEOUT, self.timeout_response)
+        return await super().forward_message(message, simulated=simulated)
+
+    # However the report ends, the inactivity timer is stopped
+    def end(self, user_id):
+        self.timeout_task.cancel()
+        super().end(user_id)
+
+    # A callback that gets called after REPORT_CREATION_TIMEOUT seconds without a reply
+    def timeout_response(self):
+        self.end(self.reporter.id)
+        asyncio.create_task(self.say("Your report has been canceled due to inactivity. You can start a new one with the `report` command."))
 
     # Show an introduction and then go to AWAITING_MESSAGE_LINK state
     async def report_start(self, message, simulated=False, introducing=False):
@@ -582,7 +664,7 @@ class UserReportCreationFlow(Flow):
             """
         else:
             # Parse out the three ID strings from the message link
-            m = re.search(r"/(\d+|@me)/(\d+)/(\d+)", message)
+            m = MESSAGE_LINK_RE.search(message)
 
             if not m:
                 return """
@@ -621,9 +703,10 @@ class UserReportCreationFlow(Flow):
 
             # Check if the user is reporting one of our messages that was created from auto-flagging
             # If so, reference the original message
-            if message.id in self.client.message_pairs:
-                self.replacement_message = message
-                message = self.client.message_aliases[message.id]
+            resent = self.client.resent_copy(message.id)
+            if resent is not None:
+                self.replacement_message = resent.replacement
+                message = resent.original
             else:
                 self.replacement_message = None
 
@@ -730,10 +813,11 @@ class UserReportCreationFlow(Flow):
                 self.react_no()
             )
         else:
-            if message.lower() in YES_KEYWORDS:
+            lowered = message.lower()
+            if lowered in YES_KEYWORDS:
                 self.victim = self.reporter
                 return await self.transition_to_state(UserReportCreationFlow.State.ADD_COMMENT)
-            elif message.lower() in NO_KEYWORDS:
+            elif lowered in NO_KEYWORDS:
                 return await self.transition_to_state(UserReportCreationFlow.State.ASK_FOR_VICTIM)
             else:
                 return "Sorry, I didn't understand that. Please reply with `yes` or `no` or click one of the buttons above."
@@ -767,10 +851,10 @@ class UserReportCreationFlow(Flow):
                     commonGuilds.append(guild)
 
             # Parse out a discriminator if the name includes one
-            discrim = re.search(r"#\d+$", message)
+            discrim = DISCRIMINATOR_RE.search(message)
             if discrim is not None:
-                discrim = str(int(discrim.group(0)[1:]))
-                username = message[:-len(discrim) - 1]
+                username = message[:discrim.start()]
+                discrim = str(int(discrim.group(1)))
             else:
                 username = message
 
@@ -822,7 +906,8 @@ class UserReportCreationFlow(Flow):
                 self.react_no()
             )
         else:
-            if message.lower() in YES_KEYWORDS:
+            lowered = message.lower()
+            if lowered in YES_KEYWORDS:
                 self.urgent = True
                 await self.say(discord.Embed(
                     title="Call 911.",
@@ -830,7 +915,7 @@ class UserReportCreationFlow(Flow):
                     color=discord.Color.red()
                 ))
                 return await self.transition_to_state(UserReportCreationFlow.State.ADD_COMMENT)
-            elif message.lower() in NO_KEYWORDS:
+            elif lowered in NO_KEYWORDS:
                 self.urgent = False
                 return await self.transition_to_state(UserReportCreationFlow.State.ADD_COMMENT)
             else:
@@ -849,7 +934,8 @@ class UserReportCreationFlow(Flow):
                 self.react_no()
             )
         else:
-            if message.lower() in YES_KEYWORDS:
+            lowered = message.lower()
+            if lowered in YES_KEYWORDS:
                 self.urgent = True
                 await self.say(discord.Embed(
                     title="Call 911.",
@@ -857,7 +943,7 @@ class UserReportCreationFlow(Flow):
                     color=discord.Color.red()
                 ))
                 return await self.transition_to_state(UserReportCreationFlow.State.ADD_COMMENT)
-            elif message.lower() in NO_KEYWORDS:
+            elif lowered in NO_KEYWORDS:
                 self.urgent = False
                 return await self.transition_to_state(UserReportCreationFlow.State.ADD_COMMENT)
             else:
@@ -897,7 +983,7 @@ class UserReportCreationFlow(Flow):
                     report_creation_flow=self
                 )
 
-                asyncio.gather(*(self.sent_report.send_to_channel(channel, assignable=True) for channel in self.client.mod_channels.values()))
+                asyncio.ensure_future(self.client.send_to_mod_channels(self.sent_report))
 
                 return await self.transition_to_state(UserReportCreationFlow.State.FINISH_REPORT)
             else:
@@ -907,7 +993,7 @@ class UserReportCreationFlow(Flow):
                 )
 
     async def finish_report(self, message, simulated=False, introducing=False):
-        self.client.flows[self.reporter.id].remove(self)
+        self.end(self.reporter.id)
         return "Thank you for reporting! You will receive a message when someone on the content moderation team has reviewed your report."
 
     @Flow.help_message("""
@@ -922,10 +1008,11 @@ class UserReportCreationFlow(Flow):
                 self.react_no()
             )
         else:
-            if message.lower() in YES_KEYWORDS:
+            lowered = message.lower()
+            if lowered in YES_KEYWORDS:
                 await self.say("Your report has been canceled.")
-                self.client.flows[self.reporter.id].remove(self)
-            elif message.lower() in NO_KEYWORDS:
+                self.end(self.reporter.id)
+            elif lowered in NO_KEYWORDS:
                 await revert()
             else:
                 return "Sorry, I didn't understand that. Please reply with `yes` or `no` or click one of the buttons above."
@@ -986,7 +1073,7 @@ class CSAMImageReviewFlow(Flow, ReportReviewFlow):
     ))
 
     def __init__(self, client, report, reviewer):
-        super().__init__(client=client, channel=reviewer.dm_channel, start_state=CSAMImageReviewFlow.State.START, quit_state=CSAMImageReviewFlow.State.QUIT)
+        super().__init__(client=client, channel=client.dm_channel(reviewer), start_state=CSAMImageReviewFlow.State.START, quit_state=CSAMImageReviewFlow.State.QUIT)
         self.report = report
         self.reviewer = reviewer
 
@@ -999,9 +1086,10 @@ class CSAMImageReviewFlow(Flow, ReportReviewFlow):
                 self.react_no()
             )
         else:
-            if message.lower() in YES_KEYWORDS:
+            lowered = message.lower()
+            if lowered in YES_KEYWORDS:
                 await self.transition_to_state(CSAMImageReviewFlow.State.VIEWING_IMAGE)
-            elif message.lower() in NO_KEYWORDS + ("unassign",):
+            elif lowered in NO_KEYWORDS or lowered == "unassign":
                 await self.transition_to_state(CSAMImageReviewFlow.State.QUIT)
             else:
                 return "Sorry, I didn't understand that. Please reply with `yes` or `no` or click one of the buttons above."
@@ -1019,20 +1107,21 @@ class CSAMImageReviewFlow(Flow, ReportReviewFlow):
             return (
                 discord.File(BytesIO(buf), self.report.img_name, spoiler=True),
                 "Use the buttons below or text commands to take action. Say `help` for more information.",
-                Reaction("🚼", toggle_handler=lambda reaction, discordClient, discordReaction, user: asyncio.create_task(self.transition_to_state(CSAMImageReviewFlow.State.REPORTING)), once_per_message=False),
-                Reaction("🔞", toggle_handler=lambda reaction, discordClient, discordReaction, user: asyncio.create_task(self.transition_to_state(CSAMImageReviewFlow.State.IS_ADULT)), once_per_message=False),
-                Reaction("🚫", toggle_handler=lambda reaction, discordClient, discordReaction, user: asyncio.create_task(self.transition_to_state(CSAMImageReviewFlow.State.QUIT)), once_per_message=False),
-                Reaction("✅", toggle_handler=lambda reaction, discordClient, discordReaction, user: asyncio.create_task(self.transition_to_state(CSAMImageReviewFlow.State.RESOLVING)), once_per_message=False)
+                self.react_state("🚼", CSAMImageReviewFlow.State.REPORTING),
+                self.react_state("🔞", CSAMImageReviewFlow.State.IS_ADULT),
+                self.react_state("🚫", CSAMImageReviewFlow.State.QUIT),
+                self.react_state("✅", CSAMImageReviewFlow.State.RESOLVING)
             )
         else:
-            if message.lower() == "ncmec":
-                self.transition_to_state(CSAMImageReviewFlow.State.REPORTING)
-            elif message.lower() == "adult":
-                self.transition_to_state(CSAMImageReviewFlow.State.IS_ADULT)
-            elif message.lower() == "resolve":
-                self.transition_to_state(CSAMImageReviewFlow.State.RESOLVING)
-            elif message.lower() == "unassign":
-                self.transition_to_state(CSAMImageReviewFlow.State.QUIT)
+            lowered = message.lower()
+            if lowered == "ncmec":
+                await self.transition_to_state(CSAMImageReviewFlow.State.REPORTING)
+            elif lowered == "adult":
+                await self.transition_to_state(CSAMImageReviewFlow.State.IS_ADULT)
+            elif lowered == "resolve":
+                await self.transition_to_state(CSAMImageReviewFlow.State.RESOLVING)
+            elif lowered == "unassign":
+                await self.transition_to_state(CSAMImageReviewFlow.State.QUIT)
             else:
                 return "Sorry, I didn't understand that. Say help for a list of text commands you can use."
 
@@ -1046,20 +1135,15 @@ class CSAMImageReviewFlow(Flow, ReportReviewFlow):
 
         # Pretend to ban the user even though we can't :(
 
-        # Delete the message
-        try:
-            await self.report.message.delete()
-        except (discord.errors.Forbidden, discord.errors.NotFound):
-            pass
-        # Delete its alias message if one exists
-        if self.report.message.id in self.client.message_aliases:
-            replacement_message = self.client.message_aliases[self.report.message.id]
-            prefix_message = self.client.message_pairs[replacement_message.id]
-            try:
-                await replacement_message.delete()
-                await prefix_message.delete()
-            except discord.errors.NotFound:
-                pass
+        # Delete the message, along with its alias messages if it has any, all at once
+        messages = [self.report.message]
+        resent = self.client.resent_messages.get(self.report.message.id)
+        if resent is not None:
+            messages += [resent.replacement, resent.prefix]
+        for result in await asyncio.gather(*(msg.delete() for msg in messages), return_exceptions=True):
+            # Messages that are already gone (or that we can't delete) are skipped
+            if isinstance(result, Exception) and not isinstance(result, (discord.errors.Forbidden, discord.errors.NotFound)):
+                raise result
 
         # Save the image's hash in our csam.hashlist file for the future
         self.client.reviewer.save_hash(self.report.img_array)
@@ -1079,16 +1163,18 @@ class CSAMImageReviewFlow(Flow, ReportReviewFlow):
             )
         else:
             # Fill out all the other fields that we need for a UserReport
-            if message.lower() == "done":
+            lowered = message.lower()
+            if lowered == "done":
                 self.comments = None
-            elif message.lower() == "unassign":
-                self.transition_to_state(CSAMImageReviewFlow.State.QUIT)
+            elif lowered == "unassign":
+                return await self.transition_to_state(CSAMImageReviewFlow.State.QUIT)
             else:
                 self.comments = message
             self.abuse_type = AbuseType.SEXUAL
             self.message = self.report.message
             self.reporter = self.reviewer
-            self.replacement_message = self.client.message_aliases[self.report.message.id] if self.report.message.id in self.client.message_aliases else None
+            resent = self.client.resent_messages.get(self.report.message.id)
+            self.replacement_message = resent.replacement if resent is not None else None
             self.victim = None
             self.urgent = False
             # Send the report
@@ -1096,7 +1182,7 @@ class CSAMImageReviewFlow(Flow, ReportReviewFlow):
                 report_creation_flow=self,
                 notify_on_resolve=False
             )
-            asyncio.gather(*(self.sent_report.send_to_channel(channel, assignable=True) for channel in self.client.mod_channels.values()))
+            asyncio.ensure_future(self.client.send_to_mod_channels(self.sent_report))
             self.report.resolve()
             return await self.inform("This report for CSAM has been resolved, and another User Report for sexual content has been created.")
 
@@ -1129,7 +1215,7 @@ class AutomatedReportReviewFlow(Flow, ReportReviewFlow):
     ))
 
     def __init__(self, client, report, reviewer):
-        super().__init__(client=client, channel=reviewer.dm_channel, start_state=AutomatedReportReviewFlow.State.REVIEW_START, quit_state=AutomatedReportReviewFlow.State.REVIEW_QUIT)
+        super().__init__(client=client, channel=client.dm_channel(reviewer), start_state=AutomatedReportReviewFlow.State.REVIEW_START, quit_state=AutomatedReportReviewFlow.State.REVIEW_QUIT)
         self.report = report
         self.reviewer = reviewer
 
@@ -1152,7 +1238,7 @@ class AutomatedReportReviewFlow(Flow, ReportReviewFlow):
         if action == "hide":
             if self.report.message_deleted:
                 await self.inform("The message has already been deleted.")
-                self.transition_to_state(AutomatedReportReviewFlow.State.REVIEW_RESTART)
+                await self.transition_to_state(AutomatedReportReviewFlow.State.REVIEW_RESTART)
                 return
 
             if await self.report.hide_message():
@@ -1165,7 +1251,7 @@ class AutomatedReportReviewFlow(Flow, ReportReviewFlow):
         elif action == "reveal":
             if self.report.message_deleted:
                 await self.inform("The message has already been deleted.")
-                self.transition_to_state(AutomatedReportReviewFlow.State.REVIEW_RESTART)
+                await self.transition_to_state(AutomatedReportReviewFlow.State.REVIEW_RESTART)
                 return
 
             if await self.report.reveal_message():
@@ -1178,7 +1264,7 @@ class AutomatedReportReviewFlow(Flow, ReportReviewFlow):
         elif action == "delete":
             if self.report.message_deleted:
                 await self.inform("The message has already been deleted.")
-                self.transition_to_state(AutomatedReportReviewFlow.State.REVIEW_RESTART)
+                await self.transition_to_state(AutomatedReportReviewFlow.State.REVIEW_RESTART)
                 return
 
             if await self.report.delete_message():
@@ -1234,6 +1320,17 @@ class AutomatedReportReviewFlow(Flow, ReportReviewFlow):
             self.report.resolve()
             return await self.inform("Thank you for resolving this report. It has been removed from the list of reports.")
 
+    # The buttons shown under the list of actions a moderator can take
+    def review_reactions(self):
+        return (
+            self.react_action("👁", "toggle_visibility"),
+            self.react_state("🗑", AutomatedReportReviewFlow.State.CONFIRM_DELETE),
+            self.react_state("🥾", AutomatedReportReviewFlow.State.CONFIRM_KICK),
+            self.react_state("💀", AutomatedReportReviewFlow.State.CONFIRM_BAN),
+            self.react_action("🚫", "unassign"),
+            self.react_action("✅", "resolve")
+        )
+
     async def review_start(self, message, simulated=False, introducing=False):
         if introducing:
             await self.say("You've been assigned to the following report:")
@@ -1249,12 +1346,7 @@ class AutomatedReportReviewFlow(Flow, ReportReviewFlow):
                     🚫 `unassign` – Unassign yourself from this report
                     ✅ `resolve` – Mark this report as resolved
                 """,
-                Reaction("👁", toggle_handler=lambda reaction, discordClient, discordReaction, user: asyncio.create_task(self.perform_action("toggle_visibility")), once_per_message=False),
-                Reaction("🗑", toggle_handler=lambda reaction, discordClient, discordReaction, user: asyncio.create_task(self.transition_to_state(AutomatedReportReviewFlow.State.CONFIRM_DELETE)), once_per_message=False),
-                Reaction("🥾", toggle_handler=lambda reaction, discordClient, discordReaction, user: asyncio.create_task(self.transition_to_state(AutomatedReportReviewFlow.State.CONFIRM_KICK)), once_per_message=False),
-                Reaction("💀", toggle_handler=lambda reaction, discordClient, discordReaction, user: asyncio.create_task(self.transition_to_state(AutomatedReportReviewFlow.State.CONFIRM_BAN)), once_per_message=False),
-                Reaction("🚫", toggle_handler=lambda reaction, discordClient, discordReaction, user: asyncio.create_task(self.perform_action("unassign")), once_per_message=False),
-                Reaction("✅", toggle_handler=lambda reaction, discordClient, discordReaction, user: asyncio.create_task(self.perform_action("resolve")), once_per_message=False)
+                *self.review_reactions()
             )
         else:
             message = message.lower()
@@ -1270,12 +1362,7 @@ class AutomatedReportReviewFlow(Flow, ReportReviewFlow):
                         🚫 `unassign`
                         ✅ `resolve`
                     """,
-                    Reaction("👁", toggle_handler=lambda reaction, discordClient, discordReaction, user: asyncio.create_task(self.perform_action("toggle_visibility")), once_per_message=False),
-                    Reaction("🗑", toggle_handler=lambda reaction, discordClient, discordReaction, user: asyncio.create_task(self.transition_to_state(AutomatedReportReviewFlow.State.CONFIRM_DELETE)), once_per_message=False),
-                    Reaction("🥾", toggle_handler=lambda reaction, discordClient, discordReaction, user: asyncio.create_task(self.transition_to_state(AutomatedReportReviewFlow.State.CONFIRM_KICK)), once_per_message=False),
-                    Reaction("💀", toggle_handler=lambda reaction, discordClient, discordReaction, user: asyncio.create_task(self.transition_to_state(AutomatedReportReviewFlow.State.CONFIRM_BAN)), once_per_message=False),
-                    Reaction("🚫", toggle_handler=lambda reaction, discordClient, discordReaction, user: asyncio.create_task(self.perform_action("unassign")), once_per_message=False),
-                    Reaction("✅", toggle_handler=lambda reaction, discordClient, discordReaction, user: asyncio.create_task(self.perform_action("resolve")), once_per_message=False)
+                    *self.review_reactions()
                 )
             elif message.split()[0] in HELP_KEYWORDS:
                 message = message[len(message.split()[0]):].strip()
@@ -1327,6 +1414,7 @@ class AutomatedReportReviewFlow(Flow, ReportReviewFlow):
 
     @Flow.help_message("Confirm whether you really want to delete this message by saying `yes` or `no`.")
     async def confirm_delete(self, message, simulated=False, introducing=False):
+        lowered = message.lower()
         if introducing:
             if self.report.message_deleted:
                 await self.inform("The message has already been deleted.")
@@ -1338,15 +1426,16 @@ class AutomatedReportReviewFlow(Flow, ReportReviewFlow):
                 self.react_yes(),
                 self.react_no()
             )
-        elif message.lower() in YES_KEYWORDS:
+        elif lowered in YES_KEYWORDS:
             await self.perform_action("delete")
-        elif message.lower() in NO_KEYWORDS:
+        elif lowered in NO_KEYWORDS:
             await self.transition_to_state(AutomatedReportReviewFlow.State.REVIEW_RESTART)
         else:
             return "Sorry, I didn't understand that. Please reply with `yes` or `no` or click one of the buttons above."
 
     @Flow.help_message("Confirm whether you really want to kick this user off the guild by saying `yes` or `no`.")
     async def confirm_kick(self, message, simulated=False, introducing=False):
+        lowered = message.lower()
         if introducing:
             if isinstance(self.report.message.channel, discord.DMChannel):
                 await self.warn("You can't kick a user from a private DM channel.")
@@ -1362,15 +1451,16 @@ class AutomatedReportReviewFlow(Flow, ReportReviewFlow):
                 self.react_yes(),
                 self.react_no()
             )
-        elif message.lower() in YES_KEYWORDS:
+        elif lowered in YES_KEYWORDS:
             await self.perform_action("kick")
-        elif message.lower() in NO_KEYWORDS:
+        elif lowered in NO_KEYWORDS:
             await self.transition_to_state(AutomatedReportReviewFlow.State.REVIEW_RESTART)
         else:
             return "Sorry, I didn't understand that. Please reply with `yes` or `no` or click one of the buttons above."
 
     @Flow.help_message("Confirm whether you really want to ban this user from the guild by saying `yes` or `no`.")
     async def confirm_ban(self, message, simulated=False, introducing=False):
+        lowered = message.lower()
         if introducing:
             if isinstance(self.report.message.channel, discord.DMChannel):
                 await self.warn("You can't ban someone form a DM channel.")
@@ -1394,9 +1484,9 @@ class AutomatedReportReviewFlow(Flow, ReportReviewFlow):
                 self.react_yes(),
                 self.react_no()
             )
-        elif message.lower() in YES_KEYWORDS:
+        elif lowered in YES_KEYWORDS:
             await self.perform_action("ban")
-        elif message.lower() in NO_KEYWORDS:
+        elif lowered in NO_KEYWORDS:
             await self.transition_to_state(AutomatedReportReviewFlow.State.REVIEW_RESTART)
         else:
             return "Sorry, I didn't understand that. Please reply with `yes` or `no` or click one of the buttons above."
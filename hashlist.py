@@ -0,0 +1,113 @@
+import os.path
+import threading
+import numpy as np
+
+# The number of set bits in every possible byte, for counting how many bits differ between hashes
+POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+# Returns the number of bits that differ between `query` and each row of `hashes` (arrays of packed hash bytes)
+# All the rows are compared at once, using NumPy's own popcount when it has one (NumPy 2.0+)
+def hamming_distances(hashes, query):
+    differences = hashes ^ query
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(differences).sum(axis=1)
+    return POPCOUNT_TABLE[differences].sum(axis=1)
+
+# The number of hashes an empty HashList has room for before it has to grow
+INITIAL_CAPACITY = 1024
+
+# A list of image hashes, kept in memory and in a file with one hash (in hex) per line, that can be searched for near matches
+# Hashes are bytes of length `hash_bytes`, and a near match is one that differs by at most `max_distance` bits
+# Every hash is split into `max_distance + 1` segments of bytes: two hashes that differ by at most `max_distance` bits can
+# differ in at most that many segments, so they're always identical in at least one of them
+# Each segment is indexed, so a search only has to compare the hashes that share a segment with it instead of the whole list
+# New hashes are written to the file together once `batch_size` of them pile up (or flush is called)
+# Hashes are compared and added from the reviewer's executor threads, so every method that touches the list holds a lock
+class HashList():
+    def __init__(self, path, hash_bytes, max_distance, batch_size=32):
+        self.path = path
+        self.hash_bytes = hash_bytes
+        self.max_distance = max_distance
+        # The (start, end) byte offsets of each segment
+        segment_count = max_distance + 1
+        bounds = [hash_bytes * i // segment_count for i in range(segment_count + 1)]
+        self.segments = list(zip(bounds, bounds[1:]))
+        # Every hash as a row of uint8s in one contiguous array
+        # The array has room for more hashes than `count` so that adding one doesn't copy the whole list (it doubles whenever it fills up)
+        self.hashes = np.empty((INITIAL_CAPACITY, hash_bytes), dtype=np.uint8)
+        self.count = 0
+        # The same hashes as bytes for O(1) exact lookups
+        self.hash_set = set()
+        # For each segment, a map from that segment's bytes to the indices of the hashes that have them
+        self.index = [{} for _ in self.segments]
+        self.batch_size = batch_size
+        # Hashes that have been added but not written to the file yet
+        self.pending = []
+        self.lock = threading.Lock()
+        if os.path.isfile(path):
+            with open(path) as file:
+                hashes = [bytes.fromhex(line.strip()) for line in file if line.strip()]
+            self.count = len(hashes)
+            self.hashes = np.empty((max(INITIAL_CAPACITY, 2 * self.count), hash_bytes), dtype=np.uint8)
+            self.hashes[:self.count] = np.frombuffer(b"".join(hashes), dtype=np.uint8).reshape(-1, hash_bytes)
+            for i, packed in enumerate(hashes):
+                self._index(i, packed)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, packed):
+        return packed in self.hash_set
+
+    # Returns how many bits `packed` differs by from the closest hash in the list, or None if none are within max_distance
+    def nearest(self, packed):
+        with self.lock:
+            # An identical hash is by far the most common match, so check for it without searching the index
+            if packed in self.hash_set:
+                return 0
+            candidates = set()
+            for (start, end), segment_index in zip(self.segments, self.index):
+                candidates.update(segment_index.get(packed[start:end], ()))
+            if not candidates:
+                return None
+            # Fancy indexing copies the rows, so they can be compared after the lock is released
+            rows = self.hashes[list(candidates)]
+        distances = hamming_distances(rows, np.frombuffer(packed, dtype=np.uint8))
+        closest = int(distances.min())
+        return closest if closest <= self.max_distance else None
+
+    # Adds a hash to the list (unless it's already in it), writing it to the file along with the other pending hashes once there are enough of them
+    def add(self, packed):
+        with self.lock:
+            if packed in self.hash_set:
+                return
+            if self.count == len(self.hashes):
+                grown = np.empty((2 * len(self.hashes), self.hash_bytes), dtype=np.uint8)
+                grown[:self.count] = self.hashes
+                self.hashes = grown
+            self.hashes[self.count] = np.frombuffer(packed, dtype=np.uint8)
+            self._index(self.count, packed)
+            self.count += 1
+            self.pending.append(packed)
+            if len(self.pending) >= self.batch_size:
+                self._write_pending()
+
+    # Appends all the pending hashes to the file in one write
+    def flush(self):
+        with self.lock:
+            self._write_pending()
+
+    # Does the work of flush for a caller that's already holding the lock
+    # The file is opened just for this append so no handle is held open for the bot's whole lifetime
+    def _write_pending(self):
+        if not self.pending:
+            return
+        with open(self.path, "a") as file:
+            file.write("".join(packed.hex() + "\n" for packed in self.pending))
+        self.pending.clear()
+
+    # Adds the hash at row `i` to the exact set and each segment's index
+    def _index(self, i, packed):
+        self.hash_set.add(packed)
+        for (start, end), segment_index in zip(self.segments, self.index):
+            segment_index.setdefault(packed[start:end], []).append(i)
\ No newline at end of file
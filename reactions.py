@@ -1,14 +1,19 @@
 import asyncio
+from contextlib import suppress
 
 # Represents a reaction with an optional click handler
 class Reaction():
-	def __init__(self, reaction, click_handler=None, unclick_handler=None, toggle_handler=None, once_per_message=True):
+	# Reactions are made for nearly every message the bot sends in a flow, so they're slotted to keep them small
+	__slots__ = ("reaction", "click_handlers", "unclick_handlers", "toggle_handlers", "once_per_message", "data")
+
+	def __init__(self, reaction, click_handler=None, unclick_handler=None, toggle_handler=None, once_per_message=True, data=None):
 		"""
 			`reaction` is the reaction to show and is usually a plain unicode emoji like 1️⃣
 			`click_handler` is a (list of) function(s) to be called when a reaction is added (i.e., clicked)
 			`unclick_handler` is a (list of) function(s) to be called when a reaction is removed (i.e., clicked again after clicking)
 			`toggle_handler` is a (list of) function(s) to be called when a reaction is either added or removed (i.e., toggled)
 			`once_per_message` is a boolean indicating if the reactions should stop listening for clicks after any of the reactions on a message are clicked
+			`data` is any extra value the handlers need (available to them as `reaction.data`), so one handler can be shared by many reactions
 		"""
 		if not isinstance(reaction, str):
 			raise TypeError("reaction must be a string")
@@ -27,7 +32,7 @@ class Reaction():
 			raise TypeError("handlers must be a callable or list of callables")
 
 		self.once_per_message = once_per_message
-		self._registeredMessages = []
+		self.data = data
 
 	# Attaches the reaction to a specified message and adds it to _registeredMessages
 	async def register_message(self, message):
@@ -36,14 +41,19 @@ class Reaction():
 		except Exception as e:
 			raise e
 		registeredMessage = (message, self)
-		self._registeredMessages.append(registeredMessage)
-		_registeredMessages.append(registeredMessage)
+		if registeredMessage not in _registeredMessages:
+			_registeredMessages.add(registeredMessage)
+			_messageIndex.setdefault(message.id, []).append(registeredMessage)
 
 	async def unregister_message(self, client, message):
 		await message.remove_reaction(self.reaction, client.user)
-		for regmsg in _registeredMessages:
-			if regmsg[0] == message and regmsg[1] == self:
-				_registeredMessages.remove(regmsg)
+		self.forget_message(message)
+
+	# Stops listening for clicks on a message without removing the reaction from it (so no request is made)
+	def forget_message(self, message):
+		if (message, self) in _registeredMessages:
+			_registeredMessages.remove((message, self))
+			_unindex((message, self))
 
 
 # A superclass for discord.Client to handle reactiosn automatically
@@ -52,15 +62,15 @@ class ReactionDelegator():
 		if user == discordClient.user:
 			return
 		removeAfter = []
-		for regmsg in _registeredMessages:
-			if regmsg[0] == reaction.message:
-				if regmsg[1].reaction == reaction.emoji:
-					for handler in regmsg[1].click_handlers:
-						asyncio.create_task(handler(regmsg[1], discordClient, reaction, user)) if asyncio.iscoroutinefunction(handler) else handler(regmsg[1], discordClient, reaction, user)
-					for handler in regmsg[1].toggle_handlers:
-						asyncio.create_task(handler(regmsg[1], discordClient, reaction, user)) if asyncio.iscoroutinefunction(handler) else handler(regmsg[1], discordClient, reaction, user)
-				if regmsg[1].once_per_message:
-					removeAfter.append(regmsg)
+		# Only the reactions registered on this message need to be looked at
+		for regmsg in tuple(_messageIndex.get(reaction.message.id, ())):
+			if regmsg[1].reaction == reaction.emoji:
+				for handler in regmsg[1].click_handlers:
+					asyncio.create_task(handler(regmsg[1], discordClient, reaction, user)) if asyncio.iscoroutinefunction(handler) else handler(regmsg[1], discordClient, reaction, user)
+				for handler in regmsg[1].toggle_handlers:
+					asyncio.create_task(handler(regmsg[1], discordClient, reaction, user)) if asyncio.iscoroutinefunction(handler) else handler(regmsg[1], discordClient, reaction, user)
+			if regmsg[1].once_per_message:
+				removeAfter.append(regmsg)
 		for regmsg in removeAfter:
 			asyncio.create_task(regmsg[1].unregister_message(discordClient, regmsg[0]))
 
@@ -68,11 +78,26 @@ class ReactionDelegator():
 	async def on_reaction_remove(discordClient, reaction, user):
 		if user == discordClient.user:
 			return
-		for regmsg in _registeredMessages:
-			if regmsg[0] == reaction.message and regmsg[1].reaction == reaction.emoji:
+		for regmsg in tuple(_messageIndex.get(reaction.message.id, ())):
+			if regmsg[1].reaction == reaction.emoji:
 				for handler in regmsg[1].unclick_handlers:
 					asyncio.create_task(handler(regmsg[1], discordClient, reaction, user)) if asyncio.iscoroutinefunction(handler) else handler(regmsg[1], discordClient, reaction, user)
 				for handler in regmsg[1].toggle_handlers:
 					asyncio.create_task(handler(regmsg[1], discordClient, reaction, user)) if asyncio.iscoroutinefunction(handler) else handler(regmsg[1], discordClient, reaction, user)
 
-_registeredMessages = []
\ No newline at end of file
+# Every registered (message, Reaction) pair
+# Pairs stay registered until they're unregistered or forgotten, and everything that registers them forgets them eventually:
+# flows when they end (see Flow.end, and the inactivity timers on UserReportCreationFlow and SOSFlow), and reports when they're resolved
+_registeredMessages = set()
+# Map from a message's ID to the (message, Reaction) pairs registered on it, so reaction events don't have to look through every registration
+_messageIndex = {}
+
+# Removes a registration from _messageIndex
+def _unindex(regmsg):
+	registrations = _messageIndex.get(regmsg[0].id)
+	if registrations is None:
+		return
+	with suppress(ValueError):
+		registrations.remove(regmsg)
+	if not registrations:
+		del _messageIndex[regmsg[0].id]
\ No newline at end of file
@@ -1,5 +1,4 @@
 import discord
-import re
 import asyncio
 import time
 from io import BytesIO
@@ -10,6 +9,28 @@ from reactions import Reaction
 import flow
 from consts import *
 
+# The color and label shown on a report's embed for each urgency, from 0 to 4
+URGENCY_COLORS = (
+    discord.Color.dark_gray().value,
+    discord.Color.green().value,
+    discord.Color.gold().value,
+    discord.Color.orange().value,
+    discord.Color.red().value
+)
+URGENCY_LABELS = ("Very Low", "Low", "Moderate", "High", "Very High")
+
+# The urgency of a user report for each abuse type (anything else gets 0)
+# Harassment reported by its own victim, and violence or harmful content that needs immediate action, are one higher
+USER_REPORT_URGENCY = {
+    AbuseType.SPAM: 0,
+    AbuseType.HATEFUL: 1,
+    AbuseType.SEXUAL: 1,
+    AbuseType.HARASS: 2,
+    AbuseType.BULLYING: 3,
+    AbuseType.VIOLENCE: 3,
+    AbuseType.HARMFUL: 3,
+    AbuseType.CSAM: 4
+}
 
 class Report():
     def __init__(self, client, flow_class, urgency=0, message=None, abuse_type=None, reviewer=None):
@@ -24,19 +45,15 @@ class Report():
         self.client = client
         self.reviewer = reviewer
         self.ReviewFlow = flow_class
+        # The ✋ shown under assignable report messages, shared by all of them so that resolve can forget it everywhere
+        self._assign_reaction = Reaction("✋", click_handler=self.reaction_attempt_assign, once_per_message=False)
 
     def as_embed(self):
         embed = discord.Embed(
-            color=(
-                discord.Color.dark_gray().value,
-                discord.Color.green().value,
-                discord.Color.gold().value,
-                discord.Color.orange().value,
-                discord.Color.red().value
-            )[self.urgency]
+            color=URGENCY_COLORS[self.urgency]
         ).add_field(
             name="Urgency",
-            value=("Very Low", "Low", "Moderate", "High", "Very High")[self.urgency],
+            value=URGENCY_LABELS[self.urgency],
             inline=False
         ).add_field(
             name="Abuse Type",
@@ -73,20 +90,20 @@ class Report():
         self._channel_messages.add((message, assignable, self_destructible))
         # Display the assignable Reaction on the new Message
         if assignable:
-            await Reaction("✋", click_handler=self.reaction_attempt_assign, once_per_message=False).register_message(message)
+            await self._assign_reaction.register_message(message)
 
         return message
 
     # Tries to assign a report to a user by checking if they are already assigned to another report
     # Used as a callback for Reaction click_handlers
     async def reaction_attempt_assign(self, reaction, discordClient, discordReaction, user):
-        if any(map(lambda _flow: isinstance(_flow, flow.ReportReviewFlow), discordClient.flows.get(user.id, []))):
+        if any(map(lambda _flow: isinstance(_flow, flow.ReportReviewFlow), discordClient.flows.get(user.id, ()))):
             try:
                 await asyncio.gather(
                     # Remove the user's reaction
                     discordReaction.message.remove_reaction(discordReaction, user),
                     # Tell the user who tried to assign themselves that they are already assigned to another report
-                    (user.dm_channel or await user.create_dm()).send(content="You already have a report assigned to you. Finish this one, or use the `unassign` command to unassign yourself.")
+                    discordClient.send_dm(user, content="You already have a report assigned to you. Finish this one, or use the `unassign` command to unassign yourself.")
                 )
             except discord.errors.Forbidden:
                 # A Forbidden error can arise in DMs
@@ -109,10 +126,8 @@ class Report():
     async def assign_to(self, moderator):
         self.assignee = moderator
         self.set_status(ReportStatus.PENDING)
-        if moderator.dm_channel is None:
-            await moderator.create_dm()
+        await self.client.ensure_dm_channel(moderator)
         self.review_flow = self.ReviewFlow(report=self, reviewer=moderator, client=self.client)
-        self.client.flows[moderator.id] = self.client.flows.get(moderator.id, [])
         self.client.flows[moderator.id].append(self.review_flow)
 
     # Remove an assignee 
@@ -120,20 +135,21 @@ class Report():
         if self.assignee is None:
             return
         self.set_status(ReportStatus.NEW)
-        self.client.flows[self.assignee.id].remove(self.review_flow)
+        self.review_flow.end(self.assignee.id)
         self.assignee = None
         self.review_flow = None
-        assignReaction = Reaction("✋", click_handler=self.reaction_attempt_assign, once_per_message=False)
         for msg in self._channel_messages:
             if msg[1]: # Check if message is "assignable"
-                asyncio.create_task(assignReaction.register_message(msg[0]))
+                asyncio.create_task(self._assign_reaction.register_message(msg[0]))
 
     def resolve(self):
         self.resolution_time = time.localtime()
         self.set_status(ReportStatus.RESOLVED)
-        self.client.flows[self.assignee.id].remove(self.review_flow)
+        self.review_flow.end(self.assignee.id)
         self.review_flow = None
         for msg in list(self._channel_messages):
+            # Stop listening for ✋ clicks, which would otherwise keep the resolved report around for as long as the bot runs
+            self._assign_reaction.forget_message(msg[0])
             if msg[2]: # Check if message is self_destructible
                 asyncio.create_task(msg[0].delete())
                 self._channel_messages.remove(msg)
@@ -165,18 +181,11 @@ class UserReport(Report):
     def __init__(self, *args, report_creation_flow=None, notify_on_resolve=True, **kwargs):
         self.report_creation_flow = report_creation_flow
         abuse_type = report_creation_flow.abuse_type
-        if abuse_type == AbuseType.SPAM:
-            urgency = 0
-        elif abuse_type == AbuseType.HATEFUL or abuse_type == AbuseType.SEXUAL:
-            urgency = 1
-        elif abuse_type == AbuseType.HARASS:
-            urgency = 3 if report_creation_flow.victim == report_creation_flow.reporter else 2
-        elif abuse_type == AbuseType.BULLYING:
-            urgency = 3
-        elif abuse_type == AbuseType.VIOLENCE or abuse_type == AbuseType.HARMFUL:
-            urgency = 4 if report_creation_flow.urgent else 3
-        elif abuse_type == AbuseType.CSAM:
-            urgency = 4
+        urgency = USER_REPORT_URGENCY.get(abuse_type, 0)
+        if abuse_type == AbuseType.HARASS and report_creation_flow.victim == report_creation_flow.reporter:
+            urgency += 1
+        elif (abuse_type == AbuseType.VIOLENCE or abuse_type == AbuseType.HARMFUL) and report_creation_flow.urgent:
+            urgency += 1
         super().__init__(*args, flow_class=flow.UserReportReviewFlow, urgency=urgency, client=report_creation_flow.client, message=report_creation_flow.message, abuse_type=abuse_type, **kwargs)
         self.comments = report_creation_flow.comments
         self.author = report_creation_flow.reporter
@@ -220,7 +229,7 @@ class UserReport(Report):
     def resolve(self, *args, **kwargs):
         super().resolve(*args, **kwargs)
         if self.notify_on_resolve:
-            asyncio.create_task(self.author.dm_channel.send(content="Your report has been resolved by our content moderation team:", embed=self.report_creation_flow.as_embed()))
+            asyncio.create_task(self.client.send_dm(self.author, content="Your report has been resolved by our content moderation team:", embed=self.report_creation_flow.as_embed()))
 
     # Deletes a comment
     async def delete_message(self):
@@ -232,8 +241,10 @@ class UserReport(Report):
         if self.replacement_message is not None:
             # Try to delete both message
             try:
-                await self.replacement_message.delete()
-                await self.client.message_pairs[self.replacement_message.id].delete()
+                # The prefix message is looked up from the replacement (if it's still remembered)
+                resent = self.client.resent_messages.get(self.replacement_message.id)
+                copies = (resent.replacement, resent.prefix) if resent is not None else (self.replacement_message,)
+                await asyncio.gather(*(msg.delete() for msg in copies))
             except:
                 return False
         else:
@@ -245,7 +256,7 @@ class UserReport(Report):
 
         # DM the user that their message has been deleted
         if self.message.author.id != self.client.user.id:
-            dm_channel = self.message.author.dm_channel or self.message.author.create_dm()
+            dm_channel = await self.client.ensure_dm_channel(self.message.author)
             await dm_channel.send(
                 content="Your message was deleted by our content moderation team:",
                 embed=discord.Embed(
@@ -305,7 +316,7 @@ class UserReport(Report):
 
     # Sends a warning to the offender that repeat offenses will get them kicked off or banned from the server
     async def warn_user(self, msg=None):
-        dm_channel = self.message.author.dm_channel or self.message.author.create_dm()
+        dm_channel = await self.client.ensure_dm_channel(self.message.author)
         embed = discord.Embed(
             description=self.message.content,
             color=discord.Color.blurple()
@@ -331,7 +342,7 @@ class UserReport(Report):
 
     # DMs the message author a tip for helping for suicides
     async def show_user_suicide_help(self):
-        dm_channel = self.message.author.dm_channel or self.message.author.create_dm()
+        dm_channel = await self.client.ensure_dm_channel(self.message.author)
         await dm_channel.send(embed=discord.Embed(
             title="We're reaching out to offer help.",
             description="One of your friends believes you may benefit from us reaching out to offer help. You can [find a local counselor](https://findtreatment.samhsa.gov/) or contact the National Suicide Prevention Lifeline at (800) 273-8255 or by visiting [suicidepreventionlifeline.org](https://suicidepreventionlifeline.org). We also recommend connecting with friends or loved ones for support.",
@@ -340,7 +351,7 @@ class UserReport(Report):
         return True
 
     async def show_user_bullying_help(self):
-        dm_channel = self.message.author.dm_channel or self.message.author.create_dm()
+        dm_channel = await self.client.ensure_dm_channel(self.message.author)
         await dm_channel.send(embed=discord.Embed(
             title="We're reaching out to offer help.",
             description="One of our content moderators believes you may be the victim of online bullying and wanted to reach out to offer help. You can [find a local counselor](https://findtreatment.samhsa.gov/) or contact the National Suicide Prevention Lifeline at (800) 273-8255 or by visiting [suicidepreventionlifeline.org](https://suicidepreventionlifeline.org). We also recommend connecting with friends or loved ones for support.",
@@ -395,7 +406,7 @@ class AutomatedReport(Report):
             return False
 
         # DM the user that their message has been deleted
-        dm_channel = self.message.author.dm_channel or self.message.author.create_dm()
+        dm_channel = await self.client.ensure_dm_channel(self.message.author)
         await dm_channel.send(
             content="Your message was deleted by our content moderation team:",
             embed=discord.Embed(
@@ -418,23 +429,10 @@ class AutomatedReport(Report):
         if self.message_hidden:
             return True
 
-        # This code is taken from ModBot.allow_user_message
+        # Same as SentBadMessageFlow.resend_message
         content = self.message.content
         if self.client.smart_spoilers:
-            reMatch = re.search(r"```(?:\S*\n)?([\s\S]*?)\n?```", content)
-            while reMatch:
-                code = reMatch.group(1).split("\n")
-                longestLine = max(map(lambda line: len(line), code))
-                code = "\n".join(f"`{{:{longestLine}}}`".format(line) for line in code)
-                content = content[:reMatch.start()] + code + content[reMatch.end():]
-                reMatch = re.search(r"```(?:\S*\n)?([\s\S]*?)\n?```", content)
-
-            reMatch = re.search(r"(`(?:[^`]|\|(?!\|))*?\|)(\|(?:[^`]|\|(?!\|))*?`)", content)
-            while reMatch:
-                content = content[:reMatch.start()] + reMatch.group(1) + "\u200b" + reMatch.group(2) + content[reMatch.end():]
-                reMatch = re.search(r"(`(?:[^`]|\|(?!\|))*?\|)(\|(?:[^`]|\|(?!\|))*?`)", content)
-
-            content = content.replace("||", "\\|\\|")
+            content = flow.sanitize_spoilers(content)
         try:
             await asyncio.gather(
                 self.prefix_message.edit(content=f"*The following message may contain inappropriate content. Click the black bar to reveal it.*\n*{self.message.author.mention} says:*"),